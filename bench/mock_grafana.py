@@ -0,0 +1,136 @@
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+folder_count = 10
+
+class MockGrafanaServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, dashboards=10, panels=5, versions=3, latency=0.0, error_rate=0.0):
+        super().__init__(address, MockGrafanaHandler)
+        self.dashboards = dashboards
+        self.panels = panels
+        self.versions = versions
+        self.latency = latency
+        self.error_rate = error_rate
+        self.folders = {folder_id: "Folder {}".format(folder_id) for folder_id in range(1, folder_count+1)}
+        self.lock = threading.Lock()
+
+    def get_dashboard(self, dashboard_id, version=None):
+        version = version or self.versions
+        panels = [{"id": panel, "type": "graph", "title": "Panel {}".format(panel),
+                   "gridPos": {"h": 8, "w": 12, "x": panel % 2 * 12, "y": panel // 2 * 8},
+                   "targets": [{"refId": "A", "expr": "sum(rate(http_requests_total{{dashboard=\"{}\", panel=\"{}\"}}[5m])) by (instance)".format(dashboard_id, panel)}]}
+                  for panel in range(self.panels)]
+        return {"id": dashboard_id, "uid": get_dashboard_uid(dashboard_id), "title": "Dashboard {}".format(dashboard_id),
+                "version": version, "schemaVersion": 27, "panels": panels}
+
+    def get_folder_id(self, dashboard_id):
+        return dashboard_id % (folder_count+1)
+
+class MockGrafanaHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def simulate(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.send_json(503, {"message": "injected error"})
+            return False
+        return True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if not self.simulate():
+            return
+        server = self.server
+        if url.path == "/api/search":
+            query = parse_qs(url.query)
+            limit = int(query.get("limit", ["1000"])[0])
+            page = int(query.get("page", ["1"])[0])
+            dashboard_ids = range((page-1)*limit+1, min(page*limit, server.dashboards)+1)
+            return self.send_json(200, [{"id": dashboard_id, "uid": get_dashboard_uid(dashboard_id), "title": "Dashboard {}".format(dashboard_id),
+                                         "type": "dash-db", "folderId": server.get_folder_id(dashboard_id)} for dashboard_id in dashboard_ids])
+        match = re.match(r"^/api/dashboards/uid/u(\d+)$", url.path)
+        if match and 0 < int(match.group(1)) <= server.dashboards:
+            dashboard_id = int(match.group(1))
+            folder_id = server.get_folder_id(dashboard_id)
+            return self.send_json(200, {"dashboard": server.get_dashboard(dashboard_id),
+                                        "meta": {"version": server.versions, "updated": "2021-01-01T00:00:00Z", "folderId": folder_id,
+                                                 "folderTitle": server.folders.get(folder_id, "General")}})
+        match = re.match(r"^/api/dashboards/id/(\d+)/versions/(\d+)$", url.path)
+        if match:
+            version = int(match.group(2))
+            return self.send_json(200, {"id": version, "dashboardId": int(match.group(1)), "version": version,
+                                        "data": server.get_dashboard(int(match.group(1)), version)})
+        match = re.match(r"^/api/dashboards/id/(\d+)/versions$", url.path)
+        if match:
+            return self.send_json(200, [{"id": version, "dashboardId": int(match.group(1)), "version": version}
+                                        for version in range(server.versions, 0, -1)])
+        match = re.match(r"^/api/folders/id/(\d+)$", url.path)
+        if match:
+            folder_id = int(match.group(1))
+            with server.lock:
+                title = server.folders.get(folder_id)
+            if title is None:
+                return self.send_json(404, {"message": "Folder not found"})
+            return self.send_json(200, {"id": folder_id, "title": title})
+        if url.path == "/api/dashboards/tags":
+            return self.send_json(200, [])
+        self.send_json(404, {"message": "Not found"})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.simulate():
+            return
+        server = self.server
+        if self.path.startswith("/api/dashboards/db"):
+            content = json.loads(body)
+            with server.lock:
+                folder_exists = content.get("folderId", 0) in server.folders or content.get("folderId", 0) == 0
+            if not folder_exists:
+                return self.send_json(400, {"message": "Folder not found"})
+            return self.send_json(200, {"status": "success", "uid": content["dashboard"].get("uid"), "version": content["dashboard"].get("version", 0)+1})
+        if self.path.startswith("/api/folders"):
+            with server.lock:
+                folder_id = max(server.folders)+1
+                server.folders[folder_id] = parse_qs(body.decode('utf-8')).get("title", ["Folder {}".format(folder_id)])[0]
+            return self.send_json(200, {"id": folder_id, "title": server.folders[folder_id]})
+        self.send_json(404, {"message": "Not found"})
+
+def get_dashboard_uid(dashboard_id):
+    return "u{}".format(dashboard_id)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mock Grafana HTTP server for benchmarks.')
+    parser.add_argument('--port', type=int, default=0, help="port to listen on, 0 picks a free port.")
+    parser.add_argument('--dashboards', type=int, default=10, help="number of dashboards served by search.")
+    parser.add_argument('--panels', type=int, default=5, help="panels per dashboard, controls payload size.")
+    parser.add_argument('--versions', type=int, default=3, help="versions per dashboard.")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request.")
+    parser.add_argument('--error_rate', type=float, default=0.0, help="fraction of requests answered with 503.")
+    params = parser.parse_args()
+    server = MockGrafanaServer(("127.0.0.1", params.port), params.dashboards, params.panels, params.versions, params.latency, params.error_rate)
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
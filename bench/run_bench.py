@@ -0,0 +1,231 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+
+bench_folder = os.path.dirname(os.path.abspath(__file__))
+src_folder = os.path.join(os.path.dirname(bench_folder), "src")
+sys.path.insert(0, src_folder)
+
+import grafana_sdk
+import grafana_backup
+
+operations = ["backup", "revision", "restore", "create"]
+s3_bucket_name = "grafana-bench"
+s3_backup_folder = "grafana/backup/"
+endpoint_patterns = [
+    ("GET", r"/api/search", "search"),
+    ("GET", r"/api/dashboards/uid/[^/]+$", "dashboard"),
+    ("GET", r"/api/dashboards/id/\d+/versions/\d+$", "version"),
+    ("GET", r"/api/dashboards/id/\d+/versions$", "versions"),
+    ("GET", r"/api/folders/id/\d+$", "folder"),
+    ("POST", r"/api/folders", "create_folder"),
+    ("POST", r"/api/dashboards/db", "restore"),
+]
+
+class ApiTimer:
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def record(self, method, url, elapsed):
+        endpoint = get_endpoint_name(method, url)
+        with self.lock:
+            self.samples[endpoint].append(elapsed)
+
+    def reset(self):
+        with self.lock:
+            samples = self.samples
+            self.samples = defaultdict(list)
+        return samples
+
+    def install(self, engine):
+        timer = self
+        request = grafana_sdk.GrafanaApi._GrafanaApi__request
+        def timed_request(api, method, url, **kwargs):
+            start = time.perf_counter()
+            try:
+                return request(api, method, url, **kwargs)
+            finally:
+                timer.record(method, url, time.perf_counter()-start)
+        grafana_sdk.GrafanaApi._GrafanaApi__request = timed_request
+        if engine == grafana_backup.async_engine:
+            import grafana_async
+            async_request = grafana_async.AsyncGrafanaApi._AsyncGrafanaApi__request
+            async def timed_async_request(api, method, url, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await async_request(api, method, url, **kwargs)
+                finally:
+                    timer.record(method, url, time.perf_counter()-start)
+            grafana_async.AsyncGrafanaApi._AsyncGrafanaApi__request = timed_async_request
+
+class MockGrafana:
+
+    def __init__(self, params, dashboards):
+        self.process = subprocess.Popen([sys.executable, os.path.join(bench_folder, "mock_grafana.py"), "--dashboards", str(dashboards),
+                                         "--panels", str(params.panels), "--versions", str(params.versions),
+                                         "--latency", str(params.latency), "--error_rate", str(params.error_rate)],
+                                        stdout=subprocess.PIPE, universal_newlines=True)
+        self.url = "http://127.0.0.1:{}".format(self.process.stdout.readline().strip())
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+def get_endpoint_name(method, url):
+    for endpoint_method, pattern, name in endpoint_patterns:
+        if method == endpoint_method and re.search(pattern, url):
+            return name
+    return "other"
+
+def get_percentile(samples, percentile):
+    ordered = sorted(samples)
+    return ordered[max(0, int(len(ordered)*percentile/100.0+0.5)-1)]
+
+def get_latency_summary(samples):
+    return {endpoint: {'calls': len(values), 'p50_ms': round(get_percentile(values, 50)*1000, 2), 'p99_ms': round(get_percentile(values, 99)*1000, 2)}
+            for endpoint, values in sorted(samples.items())}
+
+def get_peak_rss():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss*1024
+
+def get_bytes_stored(params, backup_folder):
+    if params.storage == "s3":
+        import grafana_s3
+        paginator = grafana_s3.get_s3_client().get_paginator('list_objects_v2')
+        return sum(item['Size'] for page in paginator.paginate(Bucket=s3_bucket_name) for item in page.get('Contents', []))
+    size = 0
+    for root, dirs, files in os.walk(backup_folder):
+        size += sum(os.path.getsize(os.path.join(root, file_name)) for file_name in files)
+    return size
+
+def get_bench_config(params, url, hosts, backup_folder):
+    grafana_urls = [{"name": "bench{}".format(host), "url": url, "api_key": "bench", "concurrency": params.concurrency,
+                     "max_retries": params.max_retries, "backoff_factor": params.backoff_factor} for host in range(hosts)]
+    backup = {"incremental": False, "max_in_flight": params.max_in_flight,
+              "local": {"enabled": params.storage == "local", "backup_folder": backup_folder},
+              "s3": {"enabled": params.storage == "s3", "bucket_name": s3_bucket_name, "backup_folder": s3_backup_folder}}
+    backup.update(json.loads(params.backup_options))
+    return {"grafana_urls": grafana_urls, "backup": backup}
+
+def run_operation(operation, engine):
+    if operation == "backup":
+        grafana_backup.backup_grafana_dashboard("both", engine)
+    elif operation == "revision":
+        grafana_backup.revison_grafana_backup(["all"], ["all"], engine)
+    elif operation == "restore":
+        grafana_backup.restore_grafana_dashboard(["all"], ["all"], grafana_backup.hourly_backup_type, engine)
+    elif operation == "create":
+        grafana_backup.create_grafana_dashboard(["all"], ["all"], grafana_backup.hourly_backup_type, engine)
+
+def run_scenario(params, dashboards, hosts):
+    work_folder = tempfile.mkdtemp(prefix="grafana_bench_")
+    backup_folder = os.path.join(work_folder, "backup")+os.sep
+    config_file = os.path.join(work_folder, "grafana_urls.json")
+    mock_grafana = MockGrafana(params, dashboards)
+    try:
+        with open(config_file, 'w') as fp:
+            json.dump(get_bench_config(params, mock_grafana.url, hosts, backup_folder), fp, indent=2)
+        grafana_backup.GrafanaBackupManager.grafana_config = config_file
+        timer = ApiTimer()
+        timer.install(params.engine)
+        results = []
+        for operation in params.operations:
+            timer.reset()
+            bytes_before = get_bytes_stored(params, backup_folder)
+            start = time.perf_counter()
+            run_operation(operation, params.engine)
+            elapsed = time.perf_counter()-start
+            samples = timer.reset()
+            calls = sum(len(values) for values in samples.values())
+            results.append({'operation': operation, 'seconds': round(elapsed, 3),
+                            'dashboards_per_sec': round(dashboards*hosts/elapsed, 1), 'calls_per_sec': round(calls/elapsed, 1),
+                            'bytes_written': get_bytes_stored(params, backup_folder)-bytes_before,
+                            'peak_rss_mb': round(get_peak_rss()/1024.0/1024.0, 1), 'api': get_latency_summary(samples)})
+        return {'dashboards': dashboards, 'hosts': hosts, 'engine': params.engine, 'storage': params.storage, 'operations': results}
+    finally:
+        mock_grafana.close()
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+def run_isolated_scenario(params, dashboards, hosts):
+    if params.storage != "s3":
+        return run_scenario(params, dashboards, hosts)
+    try:
+        from moto import mock_aws
+    except ImportError:
+        from moto import mock_s3 as mock_aws
+    for key in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        os.environ[key] = "bench"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    with mock_aws():
+        import grafana_s3
+        grafana_s3.get_s3_client().create_bucket(Bucket=s3_bucket_name)
+        return run_scenario(params, dashboards, hosts)
+
+def print_scenario(result):
+    print("\n{} dashboards x {} hosts, engine {}, storage {}".format(result['dashboards'], result['hosts'], result['engine'], result['storage']))
+    print("{:<10} {:>9} {:>12} {:>10} {:>14} {:>12}".format("operation", "seconds", "dashboards/s", "calls/s", "bytes written", "peak rss MB"))
+    for operation in result['operations']:
+        print("{:<10} {:>9} {:>12} {:>10} {:>14} {:>12}".format(operation['operation'], operation['seconds'], operation['dashboards_per_sec'],
+                                                               operation['calls_per_sec'], operation['bytes_written'], operation['peak_rss_mb']))
+        for endpoint, latency in operation['api'].items():
+            print("    {:<14} calls {:>7}  p50 {:>8} ms  p99 {:>8} ms".format(endpoint, latency['calls'], latency['p50_ms'], latency['p99_ms']))
+
+def get_child_args(params, dashboards, hosts):
+    args = [sys.executable, os.path.abspath(__file__), "--json", "--dashboards", str(dashboards), "--hosts", str(hosts), "--operations"]
+    args += params.operations
+    for key in ("engine", "storage", "panels", "versions", "latency", "error_rate", "concurrency", "max_in_flight",
+                "max_retries", "backoff_factor", "backup_options", "log_level"):
+        args += ["--"+key, str(getattr(params, key))]
+    return args
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Grafana backup benchmark against a local mock Grafana server.')
+    parser.add_argument('--dashboards', type=int, nargs='+', default=[10, 1000], help="dashboard counts per host to benchmark, eg: 10 1000 10000.")
+    parser.add_argument('--hosts', type=int, nargs='+', default=[1], help="host counts to benchmark, eg: 1 10 50.")
+    parser.add_argument('--operations', type=str, nargs='+', choices=operations, default=operations, help="operations to run, in order.")
+    parser.add_argument('--engine', type=str, choices=[grafana_backup.thread_engine, grafana_backup.async_engine], default=grafana_backup.thread_engine)
+    parser.add_argument('--storage', type=str, choices=["local", "s3"], default="local", help="temp dir or moto mocked s3.")
+    parser.add_argument('--panels', type=int, default=5, help="panels per dashboard, controls payload size.")
+    parser.add_argument('--versions', type=int, default=3, help="versions per dashboard for revision backups.")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds of latency added by the mock server to every request.")
+    parser.add_argument('--error_rate', type=float, default=0.0, help="fraction of requests the mock server answers with 503.")
+    parser.add_argument('--concurrency', type=int, default=grafana_backup.default_concurrency, help="concurrency of every host.")
+    parser.add_argument('--max_in_flight', type=int, default=grafana_backup.default_max_in_flight, help="max_in_flight of the async engine.")
+    parser.add_argument('--max_retries', type=int, default=3)
+    parser.add_argument('--backoff_factor', type=float, default=0.05)
+    parser.add_argument('--backup_options', type=str, default="{}", help="json merged into the backup section, eg: '{\"compression\": \"zstd\"}'.")
+    parser.add_argument('--log_level', type=str, default="WARNING", help="level of the grafana_backup logger while benchmarking.")
+    parser.add_argument('--json', action='store_true', help="print results as one json document per scenario.")
+    parser.add_argument('--output', type=str, help="write all scenario results to this json file.")
+    params = parser.parse_args()
+    logging.getLogger("grafana_backup").setLevel(params.log_level)
+
+    scenarios = [(dashboards, hosts) for hosts in params.hosts for dashboards in params.dashboards]
+    results = []
+    for dashboards, hosts in scenarios:
+        if len(scenarios) == 1:
+            result = run_isolated_scenario(params, dashboards, hosts)
+        else:
+            output = subprocess.run(get_child_args(params, dashboards, hosts), stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        if params.json:
+            print(json.dumps(result))
+        else:
+            print_scenario(result)
+    if params.output:
+        with open(params.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
@@ -0,0 +1,359 @@
+import json
+import asyncio
+import aiohttp
+import grafana_sdk
+import grafana_backup
+import grafana_metrics
+import grafana_scheduler
+from concurrent.futures import ThreadPoolExecutor
+
+class AsyncGrafanaApi:
+
+    def __init__(self, grafana_api, session):
+        self.grafana_url = grafana_api.grafana_url
+        self.grafana_api = grafana_api
+        self.session = session
+
+    async def __request(self, method, url, phase="fetch", **kwargs):
+        with grafana_metrics.timer(phase, self.grafana_api.name):
+            return await self.__retry_request(method, url, phase, **kwargs)
+
+    async def __retry_request(self, method, url, phase, **kwargs):
+        attempt = 0
+        while True:
+            delay = self.grafana_api.rate_limiter.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                async with self.session.request(method, url, **kwargs) as response:
+                    body = await response.read()
+                    status = response.status
+                    retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                if attempt >= self.grafana_api.max_retries or not (method in grafana_sdk.idempotent_methods or isinstance(exc, aiohttp.ClientConnectorError)):
+                    raise
+                delay = grafana_sdk.get_retry_delay(attempt, self.grafana_api.backoff_factor, max_backoff=self.grafana_api.max_backoff)
+                if grafana_sdk.is_past_deadline(self.grafana_api.deadline, delay):
+                    grafana_sdk.get_logger().error("API Call Failed, API: {}, error: {}, not retrying past the run deadline".format(url, str(exc)))
+                    raise
+                grafana_sdk.get_logger().warning("API Call Failed, API: {}, error: {}, retrying in {:.2f}s".format(url, str(exc), delay))
+            else:
+                if status not in grafana_sdk.get_retry_status_codes(method) or attempt >= self.grafana_api.max_retries:
+                    if status != 200:
+                        grafana_sdk.get_logger().error("API Call Error, API: {}, status_code: {}, error: {}".format(url, status, body.decode('utf-8', 'replace')))
+                    return status, (json.loads(body) if body else None)
+                delay = grafana_sdk.get_retry_delay(attempt, self.grafana_api.backoff_factor, retry_after, self.grafana_api.max_backoff)
+                if grafana_sdk.is_past_deadline(self.grafana_api.deadline, delay):
+                    grafana_sdk.get_logger().error("API Call Error, API: {}, status_code: {}, not retrying past the run deadline".format(url, status))
+                    return status, (json.loads(body) if body else None)
+                grafana_sdk.get_logger().warning("API Call Error, API: {}, status_code: {}, retrying in {:.2f}s".format(url, status, delay))
+            grafana_metrics.registry.inc('grafana_backup_retries_total', host=self.grafana_api.name, phase=phase)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def __get(self, url):
+        grafana_sdk.get_logger().debug("Request To : URL {}".format(url))
+        status, content = await self.__request('GET', url)
+        if status != 200:
+            raise Exception("Error fetching {}, status_code {}".format(url, status))
+        return content
+
+    async def search_db(self):
+        page = 1
+        while True:
+            url = "{}/api/search?type=dash-db&limit={}&page={}".format(self.grafana_url, self.grafana_api.page_size, page)
+            grafana_sdk.get_logger().debug("Request To : URL {}".format(url))
+            status, dashboards = await self.__request('GET', url, phase="discovery")
+            if status != 200:
+                raise Exception("Error searching dashboards on "+self.grafana_url)
+            yield dashboards
+            if len(dashboards) < self.grafana_api.page_size:
+                return
+            page += 1
+
+    async def search_folder(self, folder_id):
+        url = "{}/api/folders/id/{}".format(self.grafana_url, folder_id)
+        grafana_sdk.get_logger().debug("Request To : URL {}".format(url))
+        return await self.__request('GET', url, phase="folder")
+
+    async def create_folder(self, folder_title):
+        url = "{}/api/folders".format(self.grafana_url)
+        grafana_sdk.get_logger().debug("Request To : URL {}".format(url))
+        status, content = await self.__request('POST', url, phase="folder", data={"title": folder_title})
+        return content
+
+    async def dashboard_details(self, dashboard_uid):
+        return await self.__get("{}/api/dashboards/uid/{}".format(self.grafana_url, dashboard_uid))
+
+    async def restore(self, json_content):
+        url = "{}/api/dashboards/db/".format(self.grafana_url)
+        grafana_sdk.get_logger().debug("Request To : URL {}".format(url))
+        status, content = await self.__request('POST', url, phase="restore_post", data=json_content, headers={'Content-Type': 'application/json'})
+        return content
+
+    async def dashboard_versions(self, dashboard_id):
+        return await self.__get("{}/api/dashboards/id/{}/versions".format(self.grafana_url, dashboard_id))
+
+    async def dashboard_version_details(self, dashboard_id, version_no):
+        return await self.__get("{}/api/dashboards/id/{}/versions/{}".format(self.grafana_url, dashboard_id, version_no))
+
+class AsyncStorage:
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="storage")
+
+    async def run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+class HostSemaphore(asyncio.Semaphore):
+
+    def __init__(self, value, name, weight=1):
+        super().__init__(value)
+        self.name = name
+        self.weight = weight
+
+class FairGate:
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.queue = grafana_scheduler.FairQueue()
+
+    async def acquire(self, host, weight):
+        if self.slots > 0 and len(self.queue) == 0:
+            self.slots -= 1
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self.queue.push(host, weight, waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while len(self.queue):
+            host, waiter = self.queue.pop()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.slots += 1
+
+class AsyncBackupEngine:
+
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.loop = asyncio.new_event_loop()
+        self.sessions = dict()
+
+    def run(self, operation, managers, *args):
+        self.loop.run_until_complete(self.__run(operation, managers, *args))
+
+    def close(self):
+        try:
+            self.loop.run_until_complete(self.__close_sessions())
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        finally:
+            self.loop.close()
+
+    async def __close_sessions(self):
+        for gbm, session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+
+    async def __get_session(self, gbm):
+        # sessions stay open across runs of a warm engine, a reloaded host config gets a new one
+        if gbm.name in self.sessions:
+            session_gbm, session = self.sessions[gbm.name]
+            if session_gbm is gbm and not session.closed:
+                return session
+            await session.close()
+        grafana_api = gbm.grafana_api
+        timeout = aiohttp.ClientTimeout(sock_connect=grafana_api.timeout[0], sock_read=grafana_api.timeout[1])
+        connector = aiohttp.TCPConnector(limit=gbm.concurrency+gbm.version_concurrency)
+        headers = {'Authorization': 'Bearer {}'.format(grafana_api.api_key)}
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers)
+        self.sessions[gbm.name] = (gbm, session)
+        return session
+
+    async def __run(self, operation, managers, *args):
+        self.gate = FairGate(self.max_in_flight)
+        self.storage = AsyncStorage(self.max_in_flight)
+        try:
+            await asyncio.gather(*[self.__run_host(operation, gbm, *args) for gbm in managers])
+        finally:
+            self.storage.close()
+
+    async def __run_host(self, operation, gbm, *args):
+        session = await self.__get_session(gbm)
+        host_semaphore = HostSemaphore(gbm.concurrency, gbm.name, gbm.weight)
+        try:
+            await operation(gbm, AsyncGrafanaApi(gbm.grafana_api, session), host_semaphore, *args)
+        except Exception as exc:
+            grafana_sdk.get_logger().error("Error running {} on host {}, error : {}".format(operation.__name__, gbm.name, str(exc)))
+        await self.storage.run(gbm._flush_s3)
+
+    async def __limit(self, host_semaphore, coroutine_func, *args):
+        async with host_semaphore:
+            await self.gate.acquire(host_semaphore.name, host_semaphore.weight)
+            try:
+                return await coroutine_func(*args)
+            finally:
+                self.gate.release()
+
+    async def __gather(self, host_semaphore, coroutine_func, items, *args):
+        return await asyncio.gather(*[self.__limit(host_semaphore, coroutine_func, item, *args) for item in items], return_exceptions=True)
+
+    async def __stream_dashboards(self, host_semaphore, coroutine_func, gbm, api, *args):
+        # results are handed out as dashboards finish, with only a few per worker pending at any time
+        pending = set()
+        discovered = 0
+        try:
+            async for dashboards in api.search_db():
+                for dashboard in dashboards:
+                    if len(pending) >= gbm.concurrency*grafana_scheduler.pending_per_worker:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            yield get_task_result(task)
+                    pending.add(asyncio.ensure_future(self.__limit(host_semaphore, coroutine_func, dashboard, gbm, api, *args)))
+                    discovered += 1
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield get_task_result(task)
+        finally:
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        grafana_sdk.get_logger().info("Discovered {} dashboards on host {}".format(discovered, gbm.name))
+
+    async def backup(self, gbm, api, host_semaphore, backup_types):
+        manifests = dict()
+        for backup_type in backup_types:
+            await self.storage.run(gbm._store_meta_info, backup_type)
+            folder_name = gbm._get_backup_folder(backup_type)
+            await self.storage.run(gbm._open_checkpoint, folder_name)
+            manifests[folder_name] = await self.storage.run(gbm._load_manifest, folder_name)
+        gbm.incomplete = 0
+        completed = True
+        try:
+            results = [result async for result in self.__stream_dashboards(host_semaphore, self.__backup_dashboard, gbm, api, manifests)]
+            for folder_name, manifest in manifests.items():
+                entries = [result.get(folder_name) for result in results if isinstance(result, dict)]
+                await self.storage.run(gbm._store_manifest, folder_name, entries)
+                completed = completed and len(entries) == len(results) and all(entries) and gbm.incomplete == 0
+        except Exception as exc:
+            grafana_sdk.get_logger().error("Error taking backup on host {}, error : {}".format(gbm.name, str(exc)))
+            completed = False
+        for backup_type in backup_types:
+            await self.storage.run(gbm._complete_backup, backup_type, completed)
+
+    async def __backup_dashboard(self, dashboard, gbm, api, manifests):
+        previous_entries = {folder_name: manifest.get(dashboard['uid']) for folder_name, manifest in manifests.items()}
+        entries = dict()
+        try:
+            if gbm._is_expired():
+                return previous_entries
+            for folder_name, previous_entry in previous_entries.items():
+                entries[folder_name] = await self.storage.run(gbm._get_stored_entry, folder_name, dashboard, previous_entry)
+            if all(entries.values()):
+                return entries
+            dashboard_details_json = await api.dashboard_details(dashboard['uid'])
+            for folder_name, entry in entries.items():
+                if not entry:
+                    entries[folder_name] = await self.storage.run(gbm._store_dashboard, folder_name, dashboard, dashboard_details_json, previous_entries[folder_name])
+        except Exception as exc:
+            grafana_sdk.get_logger().error("Error taking backup of dashboard {} on host {}, error : {}".format(dashboard.get('uid'), gbm.name, str(exc)))
+            gbm._count_dashboards("backup", "failed")
+            gbm._mark_incomplete()
+        return {folder_name: entries.get(folder_name) or previous_entry for folder_name, previous_entry in previous_entries.items()}
+
+    async def revision(self, gbm, api, host_semaphore, dashboard_names):
+        db_names = None if "all" in dashboard_names else dashboard_names
+        await self.storage.run(gbm._load_revision_index)
+        version_semaphore = asyncio.Semaphore(gbm.version_concurrency)
+        revisions = []
+        async for revision in self.__stream_dashboards(host_semaphore, self.__revision_dashboard, gbm, api, db_names, version_semaphore):
+            if isinstance(revision, tuple):
+                revisions.append(revision)
+            if len(revisions) >= grafana_backup.commit_batch_size:
+                await self.storage.run(gbm._commit_revisions, revisions, await self.storage.run(gbm._flush_s3))
+                revisions = []
+        await self.storage.run(gbm._commit_revisions, revisions, await self.storage.run(gbm._flush_s3))
+        await self.storage.run(gbm._store_revision_index)
+        await self.storage.run(gbm._flush_s3)
+
+    async def __revision_dashboard(self, dashboard, gbm, api, db_names, version_semaphore):
+        try:
+            revision_folder_name = gbm._get_revision_folder(dashboard)
+            meta_version = await self.storage.run(gbm._get_revision_meta, revision_folder_name)
+            stored_versions = []
+            if not db_names or dashboard['uid'].lower() in db_names:
+                dashboard_versions = gbm._get_new_versions(meta_version, await api.dashboard_versions(dashboard['id']))
+                stored_versions = await asyncio.gather(*[self.__revision_version(version, gbm, api, dashboard['id'], revision_folder_name, version_semaphore)
+                                                         for version in dashboard_versions])
+            return revision_folder_name, meta_version, stored_versions
+        except Exception as exc:
+            grafana_sdk.get_logger().error("Error taking revision backup of dashboard {} on host {}, error : {}".format(dashboard.get('uid'), gbm.name, str(exc)))
+
+    async def __revision_version(self, version, gbm, api, dashboard_id, folder_name, version_semaphore):
+        try:
+            async with version_semaphore:
+                dashboard_version_details = await api.dashboard_version_details(dashboard_id, version)
+            return (version,) + await self.storage.run(gbm._store_revision, folder_name, version, dashboard_version_details)
+        except Exception as exc:
+            grafana_sdk.get_logger().error("Error taking revision {} of {} on host {}, error : {}".format(version, folder_name, gbm.name, str(exc)))
+            gbm._count_dashboards("revision", "failed")
+            return version, None, None
+
+    async def restore(self, gbm, api, host_semaphore, dashboard_names, rfrom, skip_identical=False):
+        backup_file_list = await self.storage.run(gbm._scan_backup_files, gbm.name, dashboard_names, rfrom)
+        results = await self.__gather(host_semaphore, self.__restore_dashboard, backup_file_list, gbm, api, skip_identical)
+        gbm._report("restored", results)
+
+    async def __restore_dashboard(self, backup_file, gbm, api, skip_identical):
+        try:
+            dashboard_content_json = await self.storage.run(gbm._restore_content, backup_file)
+            if skip_identical and grafana_backup.is_identical_dashboard(dashboard_content_json, await self.__get_live_dashboard(api, dashboard_content_json['dashboard']['uid'])):
+                grafana_sdk.get_logger().info("Dashboard {} is identical to live on host {}, skipping restore.".format(backup_file, gbm.name))
+                return backup_file, True, grafana_backup.identical_result
+            return grafana_sdk.get_restore_result(backup_file, await api.restore(json.dumps(dashboard_content_json)))
+        except Exception as exc:
+            return backup_file, False, str(exc)
+
+    async def __get_live_dashboard(self, api, dashboard_uid):
+        try:
+            return await api.dashboard_details(dashboard_uid)
+        except Exception:
+            return None
+
+    async def create(self, gbm, api, host_semaphore, dashboard_names, rfrom):
+        backup_file_list = await self.storage.run(gbm._scan_backup_files, gbm.name, dashboard_names, rfrom)
+        folders = dict()
+        results = await self.__gather(host_semaphore, self.__create_dashboard, backup_file_list, gbm, api, folders)
+        gbm._report("created", results)
+
+    async def __resolve_folder(self, api, folder_id, folder_title):
+        status, folder_response = await api.search_folder(folder_id)
+        if status != 200:
+            folder_response = await api.create_folder(folder_title)
+        return folder_response['id']
+
+    async def __create_dashboard(self, backup_file, gbm, api, folders):
+        try:
+            dashboard_content_json = await self.storage.run(gbm.get_backup_meta_content, backup_file)
+            folder_id = dashboard_content_json['meta']['folderId']
+            if folder_id != 0:
+                if folder_id not in folders:
+                    folders[folder_id] = asyncio.ensure_future(self.__resolve_folder(api, folder_id, dashboard_content_json['meta']['folderTitle']))
+                folder_id = await folders[folder_id]
+            return grafana_sdk.get_restore_result(backup_file, await api.restore(json.dumps(gbm._create_content(backup_file, dashboard_content_json, folder_id))))
+        except Exception as exc:
+            return backup_file, False, str(exc)
+
+def get_task_result(task):
+    if task.exception() is not None:
+        return task.exception()
+    return task.result()
@@ -1,60 +1,250 @@
 import sys
 import os
+import io
 import json
+import gzip
+import tempfile
 import grafana_sdk
+import grafana_metrics
 import argparse
 import multiprocessing
 import glob
-import boto3
+import grafana_scheduler
+import hashlib
+import fnmatch
+import threading
+import time
+import contextlib
+import signal
+import collections
 from datetime import datetime
 from multiprocessing.pool import ThreadPool
 
 hourly_backup_type = "hourly"
 daily_backup_type = "daily"
 revision_folder = "revision"
-pool = ThreadPool(processes=multiprocessing.cpu_count()-1)
+manifest_file = ".manifest"
+revision_index_file = ".index"
+checkpoint_file = ".checkpoint"
+running_status = "running"
+complete_status = "complete"
+objects_folder = "objects/"
+files_layout = "files"
+cas_layout = "cas"
+no_compression = "none"
+gzip_compression = "gzip"
+zstd_compression = "zstd"
+compression_suffixes = {no_compression: "", gzip_compression: ".gz", zstd_compression: ".zst"}
+backup_file_suffixes = tuple(".json"+suffix for suffix in compression_suffixes.values())
+default_concurrency = 4
+http_option_keys = ('connect_timeout', 'read_timeout', 'max_retries', 'backoff_factor', 'max_backoff', 'rate_limit', 'page_size')
+default_max_in_flight = 64
+commit_batch_size = 100
+thread_engine = "thread"
+async_engine = "async"
+daemon_operations = (hourly_backup_type, daily_backup_type, revision_folder, "prune")
+live_snapshot = "live"
+identical_result = "identical"
+volatile_dashboard_keys = ('id', 'version', 'iteration')
+warm_managers = None
+warm_engine = None
+
+class FolderCache:
+
+    def __init__(self, grafana_api):
+        self.grafana_api = grafana_api
+        self.folders = dict()
+        self.folder_locks = dict()
+        self.lock = threading.Lock()
+
+    def resolve(self, folder_id, folder_title):
+        with self.lock:
+            folder_lock = self.folder_locks.setdefault(folder_id, threading.Lock())
+        with folder_lock:
+            if folder_id not in self.folders:
+                folder_response = self.grafana_api.search_folder(folder_id)
+                if folder_response.status_code!=200:
+                    self.folders[folder_id] = self.grafana_api.create_folder(folder_title)['id']
+                else:
+                    self.folders[folder_id] = folder_response.json()['id']
+            return self.folders[folder_id]
+
+class CheckpointJournal:
+
+    def __init__(self, path, entries, upload=None, upload_every=100):
+        self.path = path
+        self.entries = entries
+        self.upload = upload
+        self.upload_every = upload_every
+        self.recorded = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        self.fp = open(path, 'w')
+        for entry in entries.values():
+            self.fp.write(json.dumps(entry, sort_keys=True)+"\n")
+        self.fp.flush()
+
+    def get(self, dashboard):
+        entry = self.entries.get(dashboard['uid'])
+        if entry and entry.get('version') == dashboard.get('version', entry.get('version')):
+            return entry
+        return None
+
+    def record(self, entry):
+        with self.lock:
+            self.entries[entry['uid']] = entry
+            self.fp.write(json.dumps(entry, sort_keys=True)+"\n")
+            self.fp.flush()
+            self.recorded += 1
+            upload_due = self.upload is not None and self.recorded % self.upload_every == 0
+        if upload_due:
+            self.upload()
+
+    def dumps(self):
+        with self.lock:
+            return "".join(json.dumps(entry, sort_keys=True)+"\n" for entry in self.entries.values())
+
+    def discard(self, keys):
+        with self.lock:
+            discarded = [uid for uid, entry in self.entries.items() if entry.get('key') in keys]
+            if not discarded:
+                return
+            for uid in discarded:
+                del self.entries[uid]
+            self.fp.seek(0)
+            self.fp.truncate()
+            for entry in self.entries.values():
+                self.fp.write(json.dumps(entry, sort_keys=True)+"\n")
+            self.fp.flush()
+
+    def close(self, remove=False):
+        self.fp.close()
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+    @staticmethod
+    def loads(content):
+        entries = dict()
+        for line in content.splitlines():
+            try:
+                entry = json.loads(line)
+                entries[entry['uid']] = entry
+            except (ValueError, KeyError):
+                grafana_sdk.get_logger().info("Skipping incomplete checkpoint line.")
+        return entries
 
 class GrafanaBackupManager:
 
     grafana_config = "grafana_urls.json"
     config_path = "/config/"
 
-    def __init__(self, name, grafana_url, api_key):
+    def __init__(self, name, grafana_url, api_key, concurrency=default_concurrency, http_options=None, version_concurrency=None, resume=False, weight=1):
         self.s3 = True
         self.name = name
-        current_date = datetime.now().strftime("%d-%m-%Y")
-        self.hourly_folder = "hourly/"+self.name+"/"
-        self.daily_folder = "daily/{}/".format(current_date)+self.name+"/"
-        self.grafana_api = grafana_sdk.GrafanaApi(grafana_url, api_key)
+        self.concurrency = max(1, int(concurrency))
+        self.version_concurrency = max(1, int(version_concurrency or concurrency))
+        self.incremental = False
+        self.layout = files_layout
+        self.compression = no_compression
+        self.weight = weight
+        self.manifest_lock = threading.Lock()
+        self.grafana_api = grafana_sdk.GrafanaApi(grafana_url, api_key, pool_size=self.concurrency+self.version_concurrency, name=self.name, **(http_options or {}))
+        self.start_run(resume)
         if os.path.exists(GrafanaBackupManager.grafana_config) == True:
             grafana_config_content = GrafanaBackupManager.get_grafana_content(GrafanaBackupManager.grafana_config)
             s3_backup_content = grafana_config_content['backup'].get('s3', dict())
             local_backup_content = grafana_config_content['backup'].get('local', dict())
+            self.incremental = grafana_config_content['backup'].get('incremental', False) == True
+            self.layout = grafana_config_content['backup'].get('layout', files_layout)
+            self.compression = grafana_config_content['backup'].get('compression', no_compression)
+            if self.compression not in compression_suffixes:
+                raise Exception("Unsupported backup compression "+self.compression)
             self.local = local_backup_content.get('enabled', True) == True
             self.s3 = s3_backup_content.get('enabled', False) == True
             if self.local:
                 self.backup_folder = local_backup_content.get('backup_folder', '')
                 grafana_sdk.get_logger().info("Local backup is enabled and storing under : {} ".format(self.backup_folder))
             if self.s3:
-                self.s3_ins = boto3.resource('s3')
+                import grafana_s3
+                self.s3_client = grafana_s3.get_s3_client(s3_backup_content.get('max_pool_connections', 50))
                 self.s3_bucket_name = s3_backup_content['bucket_name']
+                self.s3_writer = grafana_s3.get_s3_writer(self.s3_client, self.s3_bucket_name, s3_backup_content.get('upload_workers', 8),
+                                                          s3_backup_content.get('upload_queue_size', 32), s3_backup_content.get('multipart_threshold', 8*1024*1024))
                 self.s3_backup_folder = s3_backup_content.get('backup_folder','grafana/backup/')
                 grafana_sdk.get_logger().info("s3 backup is enabled for bucket {} and storing under : {}".format(self.s3_bucket_name, self.s3_backup_folder))
 
+    def start_run(self, resume=False):
+        self.resume = resume
+        self.manifest_cache = dict()
+        self.listing_cache = dict()
+        self.s3_objects = set()
+        self.revision_index = None
+        self.checkpoints = dict()
+        self.scheduler = None
+        self.deadline = self.grafana_api.deadline = None
+        self.incomplete = 0
+        self.failed_keys = set()
+        current_date = datetime.now().strftime("%d-%m-%Y")
+        self.hourly_folder = "hourly/"+self.name+"/"
+        self.daily_folder = "daily/{}/".format(current_date)+self.name+"/"
+
+    def close(self):
+        self.grafana_api.close()
 
     def __s3_store(self, filename, content):
+        fp = tempfile.SpooledTemporaryFile(max_size=8*1024*1024)
         try:
             grafana_sdk.get_logger().info("Storing data : {}".format(self.s3_backup_folder+filename))
-            self.s3_ins.Object(self.s3_bucket_name, self.s3_backup_folder+filename).put(Body=json.dumps(content))
+            with grafana_metrics.timer("serialize", self.name):
+                dump_backup_content(content, fp, filename)
+            size = fp.tell()
+            fp.seek(0)
         except Exception as exc:
+            fp.close()
             grafana_sdk.get_logger().error("Error storing backup on s3 {}, {}, error : {}".format(self.s3_bucket_name, filename, str(exc)))
+            return None
+        self.s3_writer.put(self.s3_backup_folder+filename, fp, self.name)
+        return size
+
+    def __s3_exists(self, filename):
+        with self.manifest_lock:
+            if filename in self.s3_objects:
+                return True
+            self.s3_objects.add(filename)
+        try:
+            # copying the object onto itself refreshes LastModified, prune keeps objects an in-flight backup re-uses
+            self.s3_client.copy_object(Bucket=self.s3_bucket_name, Key=self.s3_backup_folder+filename, MetadataDirective='REPLACE',
+                                       CopySource={'Bucket': self.s3_bucket_name, 'Key': self.s3_backup_folder+filename})
+            return True
+        except Exception:
+            return False
 
+    def __local_exists(self, filename):
+        try:
+            os.utime(self.backup_folder+filename)
+            return True
+        except OSError:
+            return False
+
+    def _flush_s3(self):
+        if not self.s3:
+            return set()
+        errors = self.s3_writer.flush(self.name)
+        if errors:
+            grafana_sdk.get_logger().error("Failed storing {} backup files on s3 {} for host {} : {}".format(len(errors), self.s3_bucket_name, self.name, [key for key, error in errors]))
+        else:
+            grafana_sdk.get_logger().info("Completed storing backup files on s3 {} for host {}.".format(self.s3_bucket_name, self.name))
+        # failures stay recorded for the whole run, a checkpoint upload may have flushed them before the run completes
+        with self.manifest_lock:
+            self.failed_keys.update(key[len(self.s3_backup_folder):] for key, error in errors)
+            return set(self.failed_keys)
 
-    def __s3_read(self, filename):
+    def __s3_read(self, filename, missing_ok=False):
         try:
-            s3_object_content = self.s3_ins.Object(self.s3_bucket_name, filename).get()["Body"].read().decode('utf-8')
-            return json.loads(s3_object_content)
+            return load_backup_content(self.s3_client.get_object(Bucket=self.s3_bucket_name, Key=filename)["Body"], filename)
         except Exception as exc:
+            if missing_ok and isinstance(exc, self.s3_client.exceptions.NoSuchKey):
+                return None
             grafana_sdk.get_logger().error("Error reading s3 {}, {}, error : {}".format(self.s3_bucket_name, filename, str(exc)))
             raise Exception("Error reading s3 bucket "+self.s3_bucket_name)
 
@@ -67,94 +257,390 @@ class GrafanaBackupManager:
 
 
     def __scan_folders(self, folder_name, filename):
+        folder_name = self.__get_folder_name(folder_name)
+        backup_files = self.__list_backup_files(folder_name)
+        manifest_files = self.__get_manifest_files(folder_name)
+        if manifest_files is not None:
+            # files the manifest does not know about are still restorable from the folder listing
+            backup_files = dict(backup_files)
+            backup_files.update({file_name: folder_name+file_name if key.startswith(objects_folder) else self.__get_folder_name(key) for file_name, key in manifest_files.items()})
+        return [backup_files[file_name] for file_name in sorted(fnmatch.filter(backup_files, filename))]
+
+    def __list_backup_files(self, folder_name):
+        with self.manifest_lock:
+            if folder_name in self.listing_cache:
+                return self.listing_cache[folder_name]
+        backup_files = dict()
         if self.s3:
-            backup_file_list = []
-            bucket = self.s3_ins.Bucket(name=self.s3_bucket_name)
-            folder_name = self.__get_folder_name(folder_name)
-            if filename != "*.json":
-                folder_name = folder_name + filename
-            for obj in bucket.objects.filter(Prefix=folder_name):
-                if not obj.key.endswith(".meta_data"):
-                    backup_file_list.append(obj.key)
-            return backup_file_list
-        if self.local:
-            folder_name = self.__get_folder_name(folder_name)
-        return glob.glob(folder_name+filename)
+            for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=self.s3_bucket_name, Prefix=folder_name, Delimiter="/"):
+                for obj in page.get('Contents', []):
+                    if obj['Key'].endswith(backup_file_suffixes):
+                        backup_files.setdefault(os.path.basename(get_backup_file_name(obj['Key'])), []).append((obj['LastModified'], obj['Key']))
+        else:
+            for suffix in compression_suffixes.values():
+                for path in glob.glob(folder_name+"*.json"+suffix):
+                    backup_files.setdefault(os.path.basename(get_backup_file_name(path)), []).append((os.path.getmtime(path), path))
+        backup_files = {file_name: max(paths)[1] for file_name, paths in backup_files.items()}
+        with self.manifest_lock:
+            self.listing_cache[folder_name] = backup_files
+        return backup_files
 
-    def dashboard_backup(self, folder_name):
+    def dashboard_backup(self, folder_names):
         try:
-            dashboards = self.grafana_api.search_db()
-            if len(dashboards)==0:
-                grafana_sdk.get_logger().error("Could not find any data for backup under {}".format(folder_name))
+            manifests = dict()
+            for folder_name in folder_names:
+                self._open_checkpoint(folder_name)
+                manifests[folder_name] = self._load_manifest(folder_name)
+            with self.manifest_lock:
+                self.incomplete = 0
+            results = self.__map_dashboards(lambda dashboard: self.__backup_dashboard(dashboard, manifests), self.grafana_api.search_db())
+            if len(results)==0:
+                grafana_sdk.get_logger().error("Could not find any data for backup under {}".format(", ".join(folder_names)))
             else:
-                grafana_sdk.get_logger().info("Scanned data for backup - {}".format(len(dashboards)))
-            for dashboard in dashboards:
-                dashboard_uri = dashboard['uid']
-                dashboard_title = dashboard['title'].replace(" ","")
-                dashboard_details_json = self.grafana_api.dashboard_details(dashboard_uri)
-                self.__store(folder_name, "{}_{}.json".format(dashboard_title.lower(), dashboard_uri.lower()), dashboard_details_json)
+                grafana_sdk.get_logger().info("Discovered {} dashboards on host {} for backup under {}".format(len(results), self.name, ", ".join(folder_names)))
+            completed = True
+            for folder_name in folder_names:
+                entries = [result.get(folder_name) for result in results]
+                self._store_manifest(folder_name, entries)
+                completed = completed and all(entries)
+            return completed and self.incomplete == 0
+        except Exception as exc:
+            grafana_sdk.get_logger().error("Error taking backup {}, error : {}".format(", ".join(folder_names), str(exc)))
+            return False
+
+    def __map_dashboards(self, func, items):
+        if self.scheduler:
+            return self.scheduler.map(self.name, func, items, self.concurrency, self.weight)
+        return list(self.__stream_dashboards(func, items))
+
+    def __stream_dashboards(self, func, items):
+        # pool.imap drains its input up front, only pull the next dashboard once a few per worker are pending
+        dashboard_pool = ThreadPool(processes=self.concurrency)
+        pending = collections.deque()
+        try:
+            for item in items:
+                pending.append(dashboard_pool.apply_async(func, (item,)))
+                if len(pending) >= self.concurrency*grafana_scheduler.pending_per_worker:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            dashboard_pool.close()
+            dashboard_pool.join()
+
+    def __backup_dashboard(self, dashboard, manifests):
+        previous_entries = {folder_name: manifest.get(dashboard['uid']) for folder_name, manifest in manifests.items()}
+        entries = dict()
+        try:
+            if self._is_expired():
+                return previous_entries
+            for folder_name, previous_entry in previous_entries.items():
+                entries[folder_name] = self._get_stored_entry(folder_name, dashboard, previous_entry)
+            if all(entries.values()):
+                return entries
+            dashboard_details_json = self.grafana_api.dashboard_details(dashboard['uid'])
+            for folder_name, entry in entries.items():
+                if not entry:
+                    entries[folder_name] = self._store_dashboard(folder_name, dashboard, dashboard_details_json, previous_entries[folder_name])
         except Exception as exc:
-            grafana_sdk.get_logger().error("Error taking backup {}, error : {}".format(folder_name, str(exc)))
+            grafana_sdk.get_logger().error("Error taking backup of dashboard {} on host {}, error : {}".format(dashboard.get('uid'), self.name, str(exc)))
+            self._count_dashboards("backup", "failed")
+            self._mark_incomplete()
+        return {folder_name: entries.get(folder_name) or previous_entry for folder_name, previous_entry in previous_entries.items()}
+
+    def _is_expired(self):
+        if self.deadline is None or not self.deadline.expired():
+            return False
+        self._count_dashboards("backup", "skipped")
+        self._mark_incomplete()
+        return True
+
+    def _mark_incomplete(self):
+        with self.manifest_lock:
+            self.incomplete += 1
+
+    def _count_dashboards(self, operation, result, count=1):
+        grafana_metrics.registry.inc('grafana_backup_dashboards_total', count, host=self.name, operation=operation, result=result)
 
-    def __scan_to_restore(self, folder_name, filename):
-        backup_file_list = self.__scan_folders(folder_name, filename)
+    def _get_stored_entry(self, folder_name, dashboard, previous_entry):
+        checkpoint = self.checkpoints.get(folder_name)
+        stored_entry = checkpoint.get(dashboard) if checkpoint else None
+        if stored_entry:
+            self._count_dashboards("backup", "checkpointed")
+            return stored_entry
+        if self._is_incremental(folder_name) and self._is_unchanged(dashboard, previous_entry):
+            self._record_checkpoint(folder_name, previous_entry)
+            self._count_dashboards("backup", "unchanged")
+            return previous_entry
+        return None
+
+    def _is_incremental(self, folder_name):
+        return self.incremental and folder_name == self.hourly_folder
+
+    def _is_unchanged(self, dashboard, previous_entry):
+        if not previous_entry or 'version' not in dashboard:
+            return False
+        return previous_entry['file'] == get_dashboard_file_name(dashboard) and previous_entry.get('version') == dashboard['version']
+
+    def _store_dashboard(self, folder_name, dashboard, dashboard_details_json, previous_entry=None):
+        meta = dashboard_details_json.get('meta', dict())
+        entry = {'uid': dashboard['uid'], 'file': get_dashboard_file_name(dashboard), 'version': meta.get('version'),
+                 'updated': meta.get('updated'), 'hash': get_content_hash(dashboard_details_json), 'dashboard_hash': get_dashboard_hash(dashboard_details_json)}
+        if self._is_incremental(folder_name) and previous_entry and 'key' in previous_entry and all(previous_entry.get(key) == entry[key] for key in ('file', 'hash')):
+            grafana_sdk.get_logger().info("Dashboard {} is unchanged under {}, keeping stored copy.".format(entry['file'], folder_name))
+            previous_entry = dict(previous_entry, dashboard_hash=entry['dashboard_hash'])
+            self._record_checkpoint(folder_name, previous_entry)
+            self._count_dashboards("backup", "unchanged")
+            return previous_entry
+        if self.layout == cas_layout:
+            entry['key'], entry['size'] = self.__store_object(entry['hash'], dashboard_details_json)
+        else:
+            entry['key'], entry['size'] = self.__store(folder_name, entry['file'], dashboard_details_json)
+        if not entry['key']:
+            raise Exception("Could not store dashboard {} under {}".format(entry['file'], folder_name))
+        self._record_checkpoint(folder_name, entry)
+        self._count_dashboards("backup", "stored")
+        return entry
+
+    def __get_checkpoint_path(self, folder_name):
+        if self.local:
+            return self.backup_folder+folder_name+checkpoint_file
+        return os.path.join(tempfile.gettempdir(), "grafana_backup", folder_name, checkpoint_file)
+
+    def _open_checkpoint(self, folder_name):
+        path = self.__get_checkpoint_path(folder_name)
+        entries = dict()
+        if self.resume:
+            try:
+                if self.s3:
+                    content = self.s3_client.get_object(Bucket=self.s3_bucket_name, Key=self.s3_backup_folder+folder_name+checkpoint_file)["Body"].read().decode('utf-8')
+                else:
+                    with open(path) as fp:
+                        content = fp.read()
+                entries = CheckpointJournal.loads(content)
+            except Exception:
+                grafana_sdk.get_logger().info("Checkpoint file is not present under {}.".format(folder_name))
+            grafana_sdk.get_logger().info("Resuming backup under {} with {} completed dashboards.".format(folder_name, len(entries)))
+        upload = (lambda: self.__upload_checkpoint(folder_name)) if self.s3 else None
+        self.checkpoints[folder_name] = CheckpointJournal(path, entries, upload)
+
+    def _record_checkpoint(self, folder_name, entry):
+        checkpoint = self.checkpoints.get(folder_name)
+        if checkpoint and entry:
+            checkpoint.record(entry)
+
+    def __upload_checkpoint(self, folder_name):
+        self.checkpoints[folder_name].discard(self._flush_s3())
+        try:
+            self.s3_client.put_object(Bucket=self.s3_bucket_name, Key=self.s3_backup_folder+folder_name+checkpoint_file, Body=self.checkpoints[folder_name].dumps().encode('utf-8'))
+        except Exception as exc:
+            grafana_sdk.get_logger().error("Error storing checkpoint on s3 {}, {}, error : {}".format(self.s3_bucket_name, folder_name, str(exc)))
+
+    def _complete_backup(self, backup_type, completed):
+        folder_name = self._get_backup_folder(backup_type)
+        failed_keys = [key for key in self._flush_s3() if key.startswith((folder_name, objects_folder))]
+        checkpoint = self.checkpoints.pop(folder_name, None)
+        if completed and not failed_keys:
+            self._store_meta_info(backup_type, status=complete_status)
+            self._flush_s3()
+            if checkpoint:
+                checkpoint.close(remove=True)
+            if self.s3:
+                try:
+                    self.s3_client.delete_object(Bucket=self.s3_bucket_name, Key=self.s3_backup_folder+folder_name+checkpoint_file)
+                except Exception as exc:
+                    grafana_sdk.get_logger().error("Error removing checkpoint on s3 {}, {}, error : {}".format(self.s3_bucket_name, folder_name, str(exc)))
+            return
+        grafana_sdk.get_logger().error("{} backup of host {} is incomplete, run again with --resume to finish it.".format(backup_type.title(), self.name))
+        if checkpoint:
+            checkpoint.discard(failed_keys)
+            if self.s3:
+                self.checkpoints[folder_name] = checkpoint
+                self.__upload_checkpoint(folder_name)
+                self.checkpoints.pop(folder_name)
+            checkpoint.close()
+
+    def _load_manifest(self, folder_name):
+        # previous entries are always carried forward, dashboards that fail or are skipped keep their stored copy
+        try:
+            return self.get_backup_meta_content(self.__get_folder_name(folder_name)+manifest_file, missing_ok=True)['dashboards']
+        except Exception:
+            grafana_sdk.get_logger().info("Manifest file is not present under {}.".format(folder_name))
+            return dict()
+
+    def _store_manifest(self, folder_name, entries):
+        failed_keys = self._flush_s3()
+        dashboards = {entry['uid']: entry for entry in entries if entry and entry.get('key') not in failed_keys}
+        self.__store(folder_name, manifest_file, {'time': datetime.now().strftime("%d-%m-%Y %H:%M:%S"), 'dashboards': dashboards})
+
+    def _get_snapshot_folder(self, name, rfrom):
+        if rfrom == hourly_backup_type:
+            return "hourly/{}/".format(name)
+        return "daily/{}/{}/".format(rfrom, name)
+
+    def _load_snapshot(self, rfrom):
+        folder_name = self.__get_folder_name(self._get_snapshot_folder(self.name, rfrom))
+        try:
+            manifest = self.get_backup_meta_content(folder_name+manifest_file, resolve=False, missing_ok=True)
+        except Exception:
+            manifest = None
+        backup_files = self.__list_backup_files(folder_name)
+        if not (manifest and 'dashboards' in manifest):
+            grafana_sdk.get_logger().info("Manifest file is not present under {}, reading {} backup files.".format(folder_name, len(backup_files)))
+            return {file_name: {'file': file_name, 'path': path} for file_name, path in backup_files.items()}
+        entries = dict(manifest['dashboards'])
+        manifest_files = set(entry['file'] for entry in entries.values())
+        entries.update({file_name: {'file': file_name, 'path': path} for file_name, path in backup_files.items() if file_name not in manifest_files})
+        return entries
+
+    def _load_live_snapshot(self):
+        return {dashboard['uid']: {'uid': dashboard['uid'], 'file': get_dashboard_file_name(dashboard), 'version': dashboard.get('version')}
+                for dashboard in self.grafana_api.search_db()}
+
+    def _read_snapshot_entry(self, entry):
+        if 'path' in entry:
+            return self.get_backup_meta_content(entry['path'], resolve=False)
+        return self.get_backup_meta_content(self.__get_folder_name(entry['key']), resolve=False)
+
+    def _scan_backup_files(self, name, dashboard_names, rfrom):
+        folder_name = self._get_snapshot_folder(name, rfrom)
+        if "all" in dashboard_names:
+            file_names = ["*.json"]
+        else:
+            file_names = ["{}.json".format(dashboard_name) for dashboard_name in dashboard_names]
+        backup_file_list = []
+        for file_name in file_names:
+            backup_file_list.extend(self.__scan_folders(folder_name, file_name))
         if len(backup_file_list)==0:
-            grafana_sdk.get_logger().error("Could not find any data for restore under {}".format(folder_name))
+            grafana_sdk.get_logger().error("Could not find any backup data under {}".format(folder_name))
         else:
-            grafana_sdk.get_logger().info("Scanned data for restore - {}".format(backup_file_list))
-        for backup_file in backup_file_list:
-            dashboard_content_json = self.get_backup_meta_content(backup_file)
-            dashboard_content_json['message'] = "Updated by grafana backup script with content {}.".format(backup_file)
-            dashboard_content_json['overwrite'] = True
-            self.grafana_api.restore(json.dumps(dashboard_content_json))
+            grafana_sdk.get_logger().info("Scanned backup data - {}".format(backup_file_list))
+        return backup_file_list
+
+    def _restore_content(self, backup_file):
+        dashboard_content_json = self.get_backup_meta_content(backup_file)
+        dashboard_content_json['message'] = "Updated by grafana backup script with content {}.".format(backup_file)
+        dashboard_content_json['overwrite'] = True
+        return dashboard_content_json
+
+    def _create_content(self, backup_file, dashboard_content_json, folder_id):
+        del dashboard_content_json['dashboard']['uid']
+        del dashboard_content_json['dashboard']['id']
+        dashboard_content_json['folderId'] = folder_id
+        dashboard_content_json['message'] = "Updated by grafana backup script with content {}.".format(backup_file)
+        dashboard_content_json['overwrite'] = True
+        return dashboard_content_json
+
+    def _report(self, action, results):
+        failed = [(backup_file, error) for backup_file, success, error in results if not success]
+        identical = len([backup_file for backup_file, success, error in results if success and error == identical_result])
+        self._count_dashboards(action, "success", len(results)-len(failed)-identical)
+        self._count_dashboards(action, "failed", len(failed))
+        self._count_dashboards(action, identical_result, identical)
+        grafana_sdk.get_logger().info("{} {} of {} dashboards on host {}.".format(action.title(), len(results)-len(failed)-identical, len(results), self.name))
+        if identical:
+            grafana_sdk.get_logger().info("Skipped {} dashboards identical to live on host {}.".format(identical, self.name))
+        for backup_file, error in failed:
+            grafana_sdk.get_logger().error("Could not {} {} on host {}, error : {}".format(action, backup_file, self.name, error))
+        return results
+
+    def __scan_to_restore(self, backup_file_list, skip_identical=False):
+        return self._report("restored", self.__map_dashboards(lambda backup_file: self.__restore_file(backup_file, skip_identical), backup_file_list))
+
+    def __restore_file(self, backup_file, skip_identical=False):
+        try:
+            dashboard_content_json = self._restore_content(backup_file)
+            if skip_identical and is_identical_dashboard(dashboard_content_json, self.__get_live_dashboard(dashboard_content_json['dashboard']['uid'])):
+                grafana_sdk.get_logger().info("Dashboard {} is identical to live on host {}, skipping restore.".format(backup_file, self.name))
+                return backup_file, True, identical_result
+            return grafana_sdk.get_restore_result(backup_file, self.grafana_api.restore(json.dumps(dashboard_content_json)))
+        except Exception as exc:
+            return backup_file, False, str(exc)
+
+    def __get_live_dashboard(self, dashboard_uid):
+        try:
+            return self.grafana_api.dashboard_details(dashboard_uid)
+        except Exception:
+            return None
 
     def __scan_to_revision(self, name, db_names=None):
-        search_db_response = self.grafana_api.search_db()
-        if len(search_db_response)==0:
+        self._load_revision_index()
+        version_pool = ThreadPool(processes=self.version_concurrency)
+        discovered = 0
+        revisions = []
+        try:
+            for revision in self.__stream_dashboards(lambda db_response: self.__revision_dashboard(db_response, db_names, version_pool), self.grafana_api.search_db()):
+                discovered += 1
+                revisions.append(revision)
+                if len(revisions) >= commit_batch_size:
+                    self._commit_revisions(revisions, self._flush_s3())
+                    revisions = []
+        finally:
+            version_pool.close()
+            version_pool.join()
+        if discovered==0:
             grafana_sdk.get_logger().error("Could not find any revision files for host {}".format(name))
         else:
-            grafana_sdk.get_logger().info("Scanned data for revison - {}".format(len(search_db_response)))
-        for db_response in search_db_response:
-            db_id = db_response['id']
-            db_uid = db_response['uid']
-            db_title = db_response['title'].replace(" ","")
-            meta_version = self.__get_revision_meta("{}/{}/{}_{}/".format(revision_folder, name, db_title.lower(), db_uid.lower()))
-            ver = [1] if  not meta_version else [meta_version]
-            if not db_names or db_uid.lower() in db_names:
-                db_title = db_response['title'].replace(" ","")
-                dashboard_versions = self.grafana_api.dashboard_versions(db_id)
-                for dashboard_version in dashboard_versions:
-                    dashboard_version_id = dashboard_version['version']
-                    if not meta_version or int(meta_version)<int(dashboard_version_id):
-                        dashboard_version_details = self.grafana_api.dashboard_version_details(db_id, dashboard_version_id)
-                        self.__store("{}/{}/{}_{}/".format(revision_folder, name, db_title.lower(), db_uid.lower()), "version{}.json".format(dashboard_version_id), dashboard_version_details)
-                        ver.append(int(dashboard_version_id))
-            self.__store_revision_meta("{}/{}/{}_{}/".format(revision_folder, name, db_title.lower(), db_uid.lower()), max(ver))
-
-    def __scan_to_create(self, folder_name, file_name):
-        backup_file_list = self.__scan_folders(folder_name, file_name)
-        if len(backup_file_list)==0:
-            grafana_sdk.get_logger().error("Could not find any data to create under {}".format(folder_name))
-        else:
-            grafana_sdk.get_logger().info("Scanned data to create db - {}".format(backup_file_list))
-        for backup_file in backup_file_list:
+            grafana_sdk.get_logger().info("Discovered {} dashboards on host {} for revision".format(discovered, self.name))
+        self._commit_revisions(revisions, self._flush_s3())
+        self._store_revision_index()
+        self._flush_s3()
+
+    def __revision_dashboard(self, db_response, db_names, version_pool):
+        try:
+            revision_folder_name = self._get_revision_folder(db_response)
+            meta_version = self._get_revision_meta(revision_folder_name)
+            stored_versions = []
+            if not db_names or db_response['uid'].lower() in db_names:
+                dashboard_versions = self._get_new_versions(meta_version, self.grafana_api.dashboard_versions(db_response['id']))
+                stored_versions = version_pool.map(lambda version: self.__revision_version(revision_folder_name, db_response['id'], version), dashboard_versions)
+            return revision_folder_name, meta_version, stored_versions
+        except Exception as exc:
+            grafana_sdk.get_logger().error("Error taking revision backup of dashboard {}, error : {}".format(db_response.get('uid'), str(exc)))
+
+    def __revision_version(self, folder_name, dashboard_id, version):
+        try:
+            dashboard_version_details = self.grafana_api.dashboard_version_details(dashboard_id, version)
+            return (version,) + self._store_revision(folder_name, version, dashboard_version_details)
+        except Exception as exc:
+            grafana_sdk.get_logger().error("Error taking revision {} of {}, error : {}".format(version, folder_name, str(exc)))
+            self._count_dashboards("revision", "failed")
+            return version, None, None
+
+    def _get_new_versions(self, meta_version, dashboard_versions):
+        return sorted(int(dashboard_version['version']) for dashboard_version in dashboard_versions
+                      if not meta_version or int(meta_version)<int(dashboard_version['version']))
+
+    def _commit_revisions(self, revisions, failed_keys):
+        for revision in revisions:
+            if not revision:
+                continue
+            folder_name, meta_version, stored_versions = revision
+            version = int(meta_version) if meta_version else 0
+            for stored_version, file_name, key in stored_versions:
+                if not key or key in failed_keys:
+                    grafana_sdk.get_logger().error("Revision {} of {} is not stored, keeping meta version at {}.".format(stored_version, folder_name, version))
+                    break
+                version = stored_version
+            revision_files = dict()
+            if self.layout == cas_layout:
+                revision_files = {file_name: key for stored_version, file_name, key in stored_versions if key and key not in failed_keys}
+            if revision_files or version != int(meta_version or 0):
+                self._store_revision_meta(folder_name, version, revision_files)
+
+    def __scan_to_create(self, backup_file_list):
+        folder_cache = FolderCache(self.grafana_api)
+        return self._report("created", self.__map_dashboards(lambda backup_file: self.__create_file(backup_file, folder_cache), backup_file_list))
+
+    def __create_file(self, backup_file, folder_cache):
+        try:
             dashboard_content_json = self.get_backup_meta_content(backup_file)
             folder_id = dashboard_content_json['meta']['folderId']
-            folder_title = dashboard_content_json['meta']['folderTitle']
             if folder_id != 0:
-                folder_response = self.grafana_api.search_folder(folder_id)
-                if folder_response.status_code!=200:
-                    new_folder_response = self.grafana_api.create_folder(folder_title)
-                    folder_id = new_folder_response['id']
-                else:
-                    folder_response = folder_response.json()
-                    folder_id = folder_response['id']
-            del dashboard_content_json['dashboard']['uid']
-            del dashboard_content_json['dashboard']['id']
-            dashboard_content_json['folderId'] = folder_id
-            dashboard_content_json['message'] = "Updated by grafana backup script with content {}.".format(backup_file)
-            dashboard_content_json['overwrite'] = True
-            self.grafana_api.restore(json.dumps(dashboard_content_json))
+                folder_id = folder_cache.resolve(folder_id, dashboard_content_json['meta']['folderTitle'])
+            return grafana_sdk.get_restore_result(backup_file, self.grafana_api.restore(json.dumps(self._create_content(backup_file, dashboard_content_json, folder_id))))
+        except Exception as exc:
+            return backup_file, False, str(exc)
 
     def revision_dashboard_backup(self, name, dashboard_names):
         grafana_sdk.get_logger().info("taking revision backup of dashboard on host {}, dashboard {}".format(name, dashboard_names))
@@ -166,190 +652,471 @@ class GrafanaBackupManager:
                 self.__scan_to_revision(name, dashboard_names)
         except Exception as exc:
             grafana_sdk.get_logger().error("Error taking revision backup {}, error : {}".format(name, str(exc)))
+        self._flush_s3()
 
     def create_dashboard(self, name, dashboard_names, rfrom):
         grafana_sdk.get_logger().info("Creating dashboard on host {}, dashboard {}, from {}".format(name, dashboard_names, rfrom))
-        all_dashboard = "all" in dashboard_names
         try:
-            if rfrom == hourly_backup_type:
-                if all_dashboard:
-                    folder_name = "hourly/{}/".format(name)
-                    self.__scan_to_create(folder_name, "*.json")
-                else:
-                    for dashboard_name in dashboard_names:
-                        folder_name = "hourly/{}/".format(name)
-                        self.__scan_to_create(folder_name, "{}.json".format(dashboard_name))
-            else:
-                if all_dashboard:
-                    folder_name = "daily/{}/{}/".format(rfrom, name)
-                    self.__scan_to_create(folder_name, "*.json")
-                else:
-                    for dashboard_name in dashboard_names:
-                        folder_name = "daily/{}/{}/".format(rfrom, name)
-                        self.__scan_to_create(folder_name, "{}.json".format(dashboard_name))
+            return self.__scan_to_create(self._scan_backup_files(name, dashboard_names, rfrom))
         except Exception as exc:
             grafana_sdk.get_logger().error("Error creating dashboard {}, error : {}".format(name, str(exc)))
 
-    def restore_dashboard(self, name, dashboard_names, rfrom):
+    def restore_dashboard(self, name, dashboard_names, rfrom, skip_identical=False):
         grafana_sdk.get_logger().info("Restoring host {}, dashboard {}, from {}".format(name, dashboard_names, rfrom))
         try:
-            all_dashboard = "all" in dashboard_names
-            if rfrom == hourly_backup_type:
-                if all_dashboard:
-                    folder_name = "hourly/{}/".format(name)
-                    self.__scan_to_restore(folder_name, "*.json")
-                else:
-                    for dashboard_name in dashboard_names:
-                        folder_name = "hourly/{}/".format(name)
-                        self.__scan_to_restore(folder_name, "{}.json".format(dashboard_name))
-            else:
-                if all_dashboard:
-                    folder_name = "daily/{}/".format(rfrom)
-                    self.__scan_to_restore(folder_name, "*.json")
-                else:
-                    for dashboard_name in dashboard_names:
-                        folder_name = "daily/{}/{}".format(rfrom, dashboard_name)
-                        self.__scan_to_restore(folder_name, "{}.json".format(dashboard_name))
+            return self.__scan_to_restore(self._scan_backup_files(name, dashboard_names, rfrom), skip_identical)
         except Exception as exc:
             grafana_sdk.get_logger().error("Error restoring dashboard {}, error : {}".format(name, str(exc)))
 
     def hourly_backup(self):
-        self._store_meta_info(hourly_backup_type)
-        self.dashboard_backup(self.hourly_folder)
+        self.snapshot_backup([hourly_backup_type])
 
     def daily_backup(self):
-        self._store_meta_info(daily_backup_type)
-        self.dashboard_backup(self.daily_folder)
+        self.snapshot_backup([daily_backup_type])
+
+    def snapshot_backup(self, backup_types):
+        for backup_type in backup_types:
+            self._store_meta_info(backup_type)
+        completed = self.dashboard_backup([self._get_backup_folder(backup_type) for backup_type in backup_types])
+        for backup_type in backup_types:
+            self._complete_backup(backup_type, completed)
+
+    def _store_revision(self, folder_name, version, dashboard_version_details):
+        file_name = "version{}.json".format(version)
+        if self.layout == cas_layout:
+            key, size = self.__store_object(get_content_hash(dashboard_version_details), dashboard_version_details)
+        else:
+            key, size = self.__store(folder_name, file_name, dashboard_version_details)
+        self._count_dashboards("revision", "stored" if key else "failed")
+        return file_name, key
 
-    def __store_revision_meta(self, folder_name, version):
+    def _store_revision_meta(self, folder_name, version, revision_files=None):
+        if revision_files:
+            stored_files = self.__get_manifest_files(self.__get_folder_name(folder_name)) or dict()
+            stored_files.update(revision_files)
+            self.__store(folder_name, manifest_file, {'time': datetime.now().strftime("%d-%m-%Y %H:%M:%S"), 'files': stored_files})
         meta_data = {'version': version}
         self.__store(folder_name, ".meta_data", meta_data)
+        with self.manifest_lock:
+            if self.revision_index is not None:
+                self.revision_index[folder_name] = meta_data
 
-    def __get_revision_meta(self, folder_name):
+    def _get_revision_meta(self, folder_name):
+        revision_index = self._load_revision_index()
+        if folder_name in revision_index:
+            return revision_index[folder_name]['version']
         try:
-            return self.get_backup_meta_content("{}.meta_data".format(self.__get_folder_name(folder_name)))['version']
+            return self.get_backup_meta_content("{}.meta_data".format(self.__get_folder_name(folder_name)), missing_ok=True)['version']
         except:
             grafana_sdk.get_logger().info("Revision meta data file is not present.")
             return None
 
-    def _store_meta_info(self, backup_type, mode="Auto"):
-        meta_data = {'time':datetime.now().strftime("%d-%m-%Y %H:%M:%S"), 'type': backup_type, 'mode': mode}
+    def _load_revision_index(self):
+        with self.manifest_lock:
+            if self.revision_index is None:
+                try:
+                    self.revision_index = self.get_backup_meta_content(self.__get_folder_name("{}/{}/".format(revision_folder, self.name))+revision_index_file, missing_ok=True)['dashboards']
+                except Exception:
+                    grafana_sdk.get_logger().info("Revision index file is not present for host {}.".format(self.name))
+                    self.revision_index = dict()
+            return self.revision_index
+
+    def _store_revision_index(self):
+        revision_index = self._load_revision_index()
+        with self.manifest_lock:
+            revision_index = dict(revision_index)
+        self.__store("{}/{}/".format(revision_folder, self.name), revision_index_file, {'time': datetime.now().strftime("%d-%m-%Y %H:%M:%S"), 'dashboards': revision_index})
+
+    def _get_backup_folder(self, backup_type):
         if backup_type == daily_backup_type:
-            folder_name = self.daily_folder
-        else:
-            folder_name = self.hourly_folder
+            return self.daily_folder
+        return self.hourly_folder
+
+    def _get_revision_folder(self, dashboard):
+        return get_revision_folder_name(self.name, dashboard)
+
+    def _store_meta_info(self, backup_type, mode="Auto", status=running_status):
+        meta_data = {'time':datetime.now().strftime("%d-%m-%Y %H:%M:%S"), 'type': backup_type, 'mode': mode, 'status': status}
+        folder_name = self._get_backup_folder(backup_type)
         self.__store(folder_name, ".meta_data", meta_data)
-        grafana_sdk.get_logger().info("Taking {} Grafana JSON file Backup for host {}.".format(backup_type.title(), self.name.title()))
+        if status == running_status:
+            grafana_sdk.get_logger().info("Taking {} Grafana JSON file Backup for host {}.".format(backup_type.title(), self.name.title()))
+        else:
+            grafana_sdk.get_logger().info("Completed {} Grafana JSON file Backup for host {}.".format(backup_type.title(), self.name.title()))
+
+    def __store_object(self, content_hash, response):
+        folder_name = get_object_folder_name(content_hash)
+        file_name = content_hash+".json"+compression_suffixes[self.compression]
+        sizes = []
+        if self.s3 and not self.__s3_exists(folder_name+file_name):
+            sizes.append(self.__s3_store(folder_name+file_name, response))
+        if self.local and not self.__local_exists(folder_name+file_name):
+            sizes.append(self.__local_store(folder_name, file_name, response))
+        return get_stored_key(folder_name+file_name, sizes)
+
+    def __get_manifest_files(self, folder_name):
+        with self.manifest_lock:
+            if folder_name not in self.manifest_cache:
+                try:
+                    manifest = self.get_backup_meta_content(folder_name+manifest_file, resolve=False, missing_ok=True)
+                    backup_files = dict(manifest.get('files', dict()))
+                    for entry in manifest.get('dashboards', dict()).values():
+                        backup_files[entry['file']] = entry['key']
+                except Exception:
+                    backup_files = None
+                self.manifest_cache[folder_name] = backup_files
+            backup_files = self.manifest_cache[folder_name]
+        return dict(backup_files) if backup_files is not None else None
 
     def __store(self, folder_name, file_name, response):
+        if file_name.endswith(".json"):
+            file_name += compression_suffixes[self.compression]
+        sizes = []
         if self.s3:
-            self.__s3_store(folder_name+file_name, response)
+            sizes.append(self.__s3_store(folder_name+file_name, response))
+        if self.local:
+            sizes.append(self.__local_store(folder_name, file_name, response))
+        return get_stored_key(folder_name+file_name, sizes)
+
+    def __local_store(self, folder_name, file_name, response):
         try:
-            if self.local:
-                folder_name = self.backup_folder+folder_name
-                grafana_sdk.get_logger().info("Storing data on folder : {}".format(folder_name))
-                os.makedirs(folder_name, exist_ok = True)
-                with open(folder_name+file_name,'w') as fp:
-                    json.dump(response, fp, indent=4, sort_keys=True)
-                fp.close()
+            folder_name = self.backup_folder+folder_name
+            grafana_sdk.get_logger().info("Storing data on folder : {}".format(folder_name))
+            os.makedirs(folder_name, exist_ok = True)
+            with grafana_metrics.timer("local_write", self.name), open(folder_name+file_name,'wb') as fp:
+                dump_backup_content(response, fp, file_name)
+                grafana_metrics.registry.inc('grafana_backup_bytes_total', fp.tell(), host=self.name, storage="local")
+                return fp.tell()
         except Exception as exc:
             grafana_sdk.get_logger().error("Error storing backup localy error : {}".format(str(exc)))
 
-    def get_backup_meta_content(self, file_name):
+    def get_backup_meta_content(self, file_name, resolve=True, missing_ok=False):
+        if resolve and file_name.endswith(".json"):
+            backup_files = self.__get_manifest_files(os.path.dirname(file_name)+"/")
+            if backup_files and backup_files.get(os.path.basename(file_name), "").startswith(objects_folder):
+                file_name = self.__get_folder_name(backup_files[os.path.basename(file_name)])
         if self.s3:
-            return self.__s3_read(file_name)
+            return self.__s3_read(file_name, missing_ok)
+        if missing_ok and not os.path.exists(file_name):
+            return None
         return GrafanaBackupManager.get_grafana_content(file_name)
 
     @staticmethod
     def get_grafana_content(file_name):
         try:
-            grafana_url_file = open(file_name)
-            grafana_url_data = json.load(grafana_url_file)
-            grafana_url_file.close()
-            return grafana_url_data
+            with open(file_name, 'rb') as grafana_url_file:
+                return load_backup_content(grafana_url_file, file_name)
         except Exception as exc:
             grafana_sdk.get_logger().error("error reading file {} , error {}".format(file_name, str(exc)))
 
+def get_content_hash(content):
+    return hashlib.sha256(json.dumps(content, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def get_dashboard_hash(content):
+    return get_content_hash({key: value for key, value in content.get('dashboard', dict()).items() if key not in volatile_dashboard_keys})
+
+def is_identical_dashboard(content, live_content):
+    if not isinstance(live_content, dict) or 'dashboard' not in live_content:
+        return False
+    return get_dashboard_hash(content) == get_dashboard_hash(live_content) and content.get('meta', dict()).get('folderId') == live_content.get('meta', dict()).get('folderId')
+
+def get_stored_key(key, sizes):
+    if None in sizes:
+        return None, None
+    return key, sizes[-1] if sizes else None
+
+def get_compression(file_name):
+    for compression, suffix in compression_suffixes.items():
+        if suffix and file_name.endswith(suffix):
+            return compression
+    return no_compression
+
+def get_backup_file_name(file_name):
+    suffix = compression_suffixes[get_compression(file_name)]
+    return file_name[:len(file_name)-len(suffix)]
+
+def get_compressor(compression, fp):
+    if compression == gzip_compression:
+        return gzip.GzipFile(fileobj=fp, mode='wb')
+    import zstandard
+    return zstandard.ZstdCompressor().stream_writer(fp, closefd=False)
+
+def get_decompressor(compression, fp):
+    if compression == gzip_compression:
+        return gzip.GzipFile(fileobj=fp, mode='rb')
+    import zstandard
+    return zstandard.ZstdDecompressor().stream_reader(fp)
+
+def dump_backup_content(content, fp, file_name):
+    compression = get_compression(file_name)
+    if compression == no_compression:
+        writer = io.TextIOWrapper(fp, encoding='utf-8')
+        json.dump(content, writer, indent=4, sort_keys=True)
+        writer.flush()
+        writer.detach()
+        return
+    compressor = get_compressor(compression, fp)
+    writer = io.TextIOWrapper(compressor, encoding='utf-8')
+    json.dump(content, writer, sort_keys=True, separators=(',', ':'))
+    writer.flush()
+    writer.detach()
+    compressor.close()
+
+def load_backup_content(fp, file_name):
+    compression = get_compression(file_name)
+    if compression == no_compression:
+        return json.loads(fp.read().decode('utf-8'))
+    return json.load(io.TextIOWrapper(get_decompressor(compression, fp), encoding='utf-8'))
+
+def get_object_folder_name(content_hash):
+    return "{}{}/".format(objects_folder, content_hash[:2])
+
+def get_dashboard_file_name(dashboard):
+    return "{}_{}.json".format(dashboard['title'].replace(" ","").lower(), dashboard['uid'].lower())
+
+def get_revision_folder_name(name, dashboard):
+    return "{}/{}/{}_{}/".format(revision_folder, name, dashboard['title'].replace(" ","").lower(), dashboard['uid'].lower())
+
 def get_grafana_mapper(grafana_url):
     try:
         name = grafana_url['name']
         url = grafana_url['url']
         api_key = grafana_url['api_key']
-        return name, url, api_key
+        concurrency = grafana_url.get('concurrency', default_concurrency)
+        version_concurrency = grafana_url.get('version_concurrency', concurrency)
+        http_options = {key: grafana_url[key] for key in http_option_keys if key in grafana_url}
+        weight = grafana_url.get('weight', 1)
+        return name, url, api_key, concurrency, http_options, version_concurrency, weight
     except Exception as exc:
         grafana_sdk.get_logger().error("error mapping grafana host config file, {}".format(str(exc)))
         sys.exit(0)
 
-def revison_grafana_backup(revision_hosts=["all"], dashboard_names=["all"]):
-    grafana_sdk.get_logger().info("Running Grafana Revision script!")
-    all_hosts = "all" in revision_hosts
+def get_backup_managers(hosts=["all"], resume=False):
+    all_hosts = "all" in hosts
+    managers = []
     for grafana_url in GrafanaBackupManager.get_grafana_content(GrafanaBackupManager.grafana_config)['grafana_urls']:
-        name, url, api_key = get_grafana_mapper(grafana_url)
-        if all_hosts or name in revision_hosts:
-            gbm = GrafanaBackupManager(name, url, api_key)
-            pool.apply_async(gbm.revision_dashboard_backup, (name, dashboard_names))
+        name, url, api_key, concurrency, http_options, version_concurrency, weight = get_grafana_mapper(grafana_url)
+        if not all_hosts and name not in hosts:
+            grafana_sdk.get_logger().info("could not find host - {} in {}!".format(name, hosts))
+        elif warm_managers is not None and name in warm_managers:
+            warm_managers[name].start_run(resume)
+            managers.append(warm_managers[name])
         else:
-            grafana_sdk.get_logger().info("could not find host - {} in {}!".format(name, revision_hosts))
-    pool.close()
-    pool.join()
+            managers.append(GrafanaBackupManager(name, url, api_key, concurrency, http_options, version_concurrency, resume, weight))
+            if warm_managers is not None:
+                warm_managers[name] = managers[-1]
+    return managers
+
+def close_warm_managers():
+    global warm_engine
+    for gbm in warm_managers.values():
+        gbm.close()
+    warm_managers.clear()
+    if warm_engine is not None:
+        warm_engine.close()
+        warm_engine = None
+    if 'grafana_s3' in sys.modules:
+        sys.modules['grafana_s3'].close_s3_writer()
+
+def close_managers(managers):
+    # the daemon keeps its managers warm, one-shot runs release their HTTP sessions after each operation
+    if warm_managers is None:
+        for gbm in managers:
+            gbm.close()
+
+def run_in_pool(tasks, processes=None):
+    pool = ThreadPool(processes=processes or max(1, min(len(tasks), multiprocessing.cpu_count()-1)))
+    try:
+        results = [pool.apply_async(func, args) for func, args in tasks]
+    finally:
+        pool.close()
+        pool.join()
+    return [result.get() if result.successful() else None for result in results]
+
+def run_async_engine(operation, managers, *args):
+    global warm_engine
+    import grafana_async
+    engine = warm_engine
+    if engine is None:
+        backup_content = GrafanaBackupManager.get_grafana_content(GrafanaBackupManager.grafana_config)['backup']
+        engine = grafana_async.AsyncBackupEngine(backup_content.get('max_in_flight', default_max_in_flight))
+        # the daemon keeps the event loop and the HTTP sessions of every host open between runs
+        if warm_managers is not None:
+            warm_engine = engine
+    try:
+        engine.run(getattr(engine, operation), managers, *args)
+    finally:
+        if engine is not warm_engine:
+            engine.close()
+
+def export_run_metrics(operation, start):
+    metrics_content = GrafanaBackupManager.get_grafana_content(GrafanaBackupManager.grafana_config)['backup'].get('metrics', dict())
+    grafana_metrics.export_metrics(metrics_content, operation, time.time()-start)
+
+def revison_grafana_backup(revision_hosts=["all"], dashboard_names=["all"], engine=thread_engine):
+    grafana_sdk.get_logger().info("Running Grafana Revision script!")
+    start = time.time()
+    managers = get_backup_managers(revision_hosts)
+    try:
+        if engine == async_engine:
+            run_async_engine('revision', managers, dashboard_names)
+        else:
+            run_in_pool([(gbm.revision_dashboard_backup, (gbm.name, dashboard_names)) for gbm in managers])
+    finally:
+        close_managers(managers)
+    export_run_metrics("revision", start)
     grafana_sdk.get_logger().info("Completed running Grafana Revision!")
 
-def create_grafana_dashboard(create_hosts=["all"], dashboard_names=["all"], rfrom=hourly_backup_type):
+def create_grafana_dashboard(create_hosts=["all"], dashboard_names=["all"], rfrom=hourly_backup_type, engine=thread_engine):
     grafana_sdk.get_logger().info("Running Grafana Create script!")
-    all_hosts = "all" in create_hosts
-    for grafana_url in GrafanaBackupManager.get_grafana_content(GrafanaBackupManager.grafana_config)['grafana_urls']:
-        name, url, api_key = get_grafana_mapper(grafana_url)
-        if all_hosts or name in create_hosts:
-            gbm = GrafanaBackupManager(name, url, api_key)
-            pool.apply_async(gbm.create_dashboard, (name, dashboard_names, rfrom))
+    start = time.time()
+    managers = get_backup_managers(create_hosts)
+    try:
+        if engine == async_engine:
+            run_async_engine('create', managers, dashboard_names, rfrom)
         else:
-            grafana_sdk.get_logger().info("could not find host - {} in {}!".format(name, create_hosts))
-    pool.close()
-    pool.join()
+            run_in_pool([(gbm.create_dashboard, (gbm.name, dashboard_names, rfrom)) for gbm in managers])
+    finally:
+        close_managers(managers)
+    export_run_metrics("create", start)
     grafana_sdk.get_logger().info("Completed running Grafana Create!")
 
-def restore_grafana_dashboard(restore_hosts=["all"], dashboard_names=["all"], rfrom=hourly_backup_type):
+def restore_grafana_dashboard(restore_hosts=["all"], dashboard_names=["all"], rfrom=hourly_backup_type, engine=thread_engine, skip_identical=False):
     grafana_sdk.get_logger().info("Running Grafana Restore script!")
-    all_hosts = "all" in restore_hosts
-    for grafana_url in GrafanaBackupManager.get_grafana_content(GrafanaBackupManager.grafana_config)['grafana_urls']:
-        name, url, api_key = get_grafana_mapper(grafana_url)
-        if all_hosts or name in restore_hosts:
-            gbm = GrafanaBackupManager(name, url, api_key)
-            pool.apply_async(gbm.restore_dashboard, (name, dashboard_names, rfrom))
+    start = time.time()
+    managers = get_backup_managers(restore_hosts)
+    try:
+        if engine == async_engine:
+            run_async_engine('restore', managers, dashboard_names, rfrom, skip_identical)
         else:
-            grafana_sdk.get_logger().info("could not find host - {} in {}!".format(name, restore_hosts))
-    pool.close()
-    pool.join()
+            run_in_pool([(gbm.restore_dashboard, (gbm.name, dashboard_names, rfrom, skip_identical)) for gbm in managers])
+    finally:
+        close_managers(managers)
+    export_run_metrics("restore", start)
     grafana_sdk.get_logger().info("Completed running Grafana Restore!")
 
+def diff_grafana_backup(diff_hosts=["all"], dashboard_names=["all"], dfrom=hourly_backup_type, dto=live_snapshot, report_file=None):
+    import grafana_diff
+    grafana_sdk.get_logger().info("Running Grafana Diff script!")
+    managers = get_backup_managers(diff_hosts)
+    try:
+        reports = run_in_pool([(grafana_diff.diff_snapshots, (gbm, dfrom, dto, dashboard_names)) for gbm in managers])
+    finally:
+        close_managers(managers)
+    reports = [report for report in reports if report]
+    if report_file:
+        with open(report_file, 'w') as fp:
+            json.dump(reports, fp, indent=2)
+        grafana_sdk.get_logger().info("Stored diff report under {}".format(report_file))
+    grafana_sdk.get_logger().info("Completed running Grafana Diff!")
+    return reports
+
+def prune_grafana_backup(prune_hosts=["all"], dry_run=False):
+    import grafana_retention
+    grafana_sdk.get_logger().info("Running Grafana Retention script!")
+    start = time.time()
+    host_names = None
+    if "all" not in prune_hosts:
+        host_names = [get_grafana_mapper(grafana_url)[0] for grafana_url in GrafanaBackupManager.get_grafana_content(GrafanaBackupManager.grafana_config)['grafana_urls']]
+        host_names = [name for name in host_names if name.lower() in prune_hosts]
+    backup_content = GrafanaBackupManager.get_grafana_content(GrafanaBackupManager.grafana_config)['backup']
+    reports = grafana_retention.prune(backup_content, host_names, dry_run)
+    if not dry_run:
+        export_run_metrics("prune", start)
+    grafana_sdk.get_logger().info("Completed running Grafana Retention!")
+    return reports
 
-def backup_grafana_dashboard(backup_type):
+def backup_grafana_dashboard(backup_type, engine=thread_engine, resume=False, deadline=None):
     grafana_sdk.get_logger().info("Running Grafana Backup script!")
-    for grafana_url in GrafanaBackupManager.get_grafana_content(GrafanaBackupManager.grafana_config)['grafana_urls']:
-        name, url, api_key = get_grafana_mapper(grafana_url)
-        gbm = GrafanaBackupManager(name, url, api_key)
-        try:
-            if backup_type == hourly_backup_type:
-                pool.apply_async(gbm.hourly_backup, ())
-            elif backup_type == daily_backup_type:
-                pool.apply_async(gbm.daily_backup, ())
-            else:
-                pool.apply_async(gbm.hourly_backup, ())
-                pool.apply_async(gbm.daily_backup, ())
-        except Exception as e:
-            grafana_sdk.get_logger().error("Error running backup tasks : {}".format(str(e)))
-    pool.close()
-    pool.join()
+    start = time.time()
+    backup_types = [hourly_backup_type, daily_backup_type] if backup_type == "both" else [backup_type]
+    managers = get_backup_managers(resume=resume)
+    try:
+        backup_content = GrafanaBackupManager.get_grafana_content(GrafanaBackupManager.grafana_config)['backup']
+        deadline = deadline or backup_content.get('deadline_seconds')
+        run_deadline = grafana_scheduler.RunDeadline(deadline) if deadline else None
+        for gbm in managers:
+            gbm.deadline = gbm.grafana_api.deadline = run_deadline
+        if engine == async_engine:
+            run_async_engine('backup', managers, backup_types)
+        elif managers:
+            scheduler = grafana_scheduler.BackupScheduler(min(backup_content.get('max_in_flight', default_max_in_flight), sum(gbm.concurrency for gbm in managers)))
+            try:
+                for gbm in managers:
+                    gbm.scheduler = scheduler
+                run_in_pool([(gbm.snapshot_backup, (backup_types,)) for gbm in managers], len(managers))
+            finally:
+                scheduler.close()
+    finally:
+        close_managers(managers)
+    export_run_metrics("backup", start)
     grafana_sdk.get_logger().info("Completed taking Grafana JSON Backup!")
 
+def run_daemon_operations(operations, engine=thread_engine):
+    backup_types = [operation for operation in (hourly_backup_type, daily_backup_type) if operation in operations]
+    if len(backup_types) == 2:
+        backup_grafana_dashboard("both", engine)
+    elif backup_types:
+        backup_grafana_dashboard(backup_types[0], engine)
+    if revision_folder in operations:
+        revison_grafana_backup(["all"], ["all"], engine)
+    if "prune" in operations:
+        prune_grafana_backup(["all"])
+
+def run_daemon(engine=thread_engine):
+    global warm_managers
+    daemon_content = GrafanaBackupManager.get_grafana_content(GrafanaBackupManager.grafana_config)['backup'].get('daemon', dict())
+    schedules = {operation: grafana_scheduler.CronSchedule(daemon_content[operation]) for operation in daemon_operations if daemon_content.get(operation)}
+    if not schedules:
+        grafana_sdk.get_logger().error("No daemon schedule found in backup section of {}".format(GrafanaBackupManager.grafana_config))
+        sys.exit(1)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    warm_managers = dict()
+    config_time = os.path.getmtime(GrafanaBackupManager.grafana_config)
+    next_runs = {operation: schedule.next_time(datetime.now()) for operation, schedule in schedules.items()}
+    grafana_sdk.get_logger().info("Running Grafana Backup daemon, schedule {}".format({operation: schedule.expression for operation, schedule in schedules.items()}))
+    try:
+        while not stop.is_set():
+            run_at = min(next_runs.values())
+            if stop.wait(max(0, (run_at-datetime.now()).total_seconds())):
+                break
+            operations = [operation for operation, next_run in next_runs.items() if next_run <= datetime.now()]
+            if os.path.getmtime(GrafanaBackupManager.grafana_config) != config_time:
+                grafana_sdk.get_logger().info("Config file {} changed, reconnecting hosts.".format(GrafanaBackupManager.grafana_config))
+                config_time = os.path.getmtime(GrafanaBackupManager.grafana_config)
+                close_warm_managers()
+            try:
+                run_daemon_operations(operations, engine)
+            except Exception as exc:
+                grafana_sdk.get_logger().error("Error running {}, error : {}".format(", ".join(operations), str(exc)))
+            for operation in operations:
+                next_runs[operation] = schedules[operation].next_time(datetime.now())
+    finally:
+        close_warm_managers()
+        warm_managers = None
+    grafana_sdk.get_logger().info("Stopped Grafana Backup daemon!")
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Grafana backup script.')
     parser.add_argument('-b','--backup', type=str, choices=['hourly', 'daily', 'both'], help="backup type needed for script to invoke backup.")
     parser.add_argument('-r', '--restore', type=str, metavar='N', nargs='+', help="restore grafana hostname, \"all\" to restore all grafana urls.")
     parser.add_argument('-c', '--create', type=str, metavar='N', nargs='+', help="create grafana db for hostname, specify \"all\" to create db of all grafana urls.")
     parser.add_argument('-rb','--revision_backup', type=str, metavar='N', nargs='+', help="revison backup, specify \"all\" to take backup of all grafana urls.")
+    parser.add_argument('-p', '--prune', type=str, metavar='N', nargs='+', help="prune backups by the retention policy of the backup section, \"all\" to prune all grafana urls.")
+    parser.add_argument('-d', '--diff', type=str, metavar='N', nargs='+', help="diff snapshots of grafana hostname, \"all\" to diff all grafana urls.")
+    parser.add_argument('-dto', '--diff_to', type=str, default=live_snapshot, help="Used with diff option, snapshot compared against restore_from, hourly, date eg: 28-4-2020 or live.")
+    parser.add_argument('--report', type=str, help="Used with diff option, write the diff report as json to the given file.")
+    parser.add_argument('--skip_identical', action='store_true', help="Used with restore option, skip dashboards identical to live Grafana instead of posting them.")
+    parser.add_argument('--dry_run', action='store_true', help="Used with prune option, only report what would be deleted.")
     parser.add_argument('-db_uid', '--dashboard_uid', default=["all"], type=str, metavar='N', nargs='+', help="restore/create/revision grafana dashboard uid, \"all\" for all grafana dashboard.")
-    parser.add_argument('-rfrom', '--restore_from', type=str, default="hourly", help="Used with restore option, either pass hourly or date eg: 28-4-2020")
+    parser.add_argument('-rfrom', '--restore_from', type=str, default="hourly", help="Used with restore/create/diff option, either pass hourly or date eg: 28-4-2020")
+    parser.add_argument('-engine', '--engine', type=str, choices=[thread_engine, async_engine], default=thread_engine, help="execution engine, \"async\" drives all hosts and dashboards from one event loop.")
+    parser.add_argument('--deadline', type=float, help="Used with backup option, seconds after which no more dashboards are fetched, defaults to deadline_seconds of the backup section.")
+    parser.add_argument('--resume', action='store_true', help="Used with backup option, skip dashboards already stored by an interrupted run of the same backup.")
+    parser.add_argument('--daemon', action='store_true', help="keep running and take hourly/daily/revision backups and prune on the daemon schedule of the backup section.")
+    parser.add_argument('--profile', type=str, help="write a cProfile of this run to the given file, read it with python -m pstats.")
     parser.add_argument('-conf', '--config_file', type=str, default=GrafanaBackupManager.grafana_config, help="full path to grafana config file.")
     params = parser.parse_args()
     backup = params.backup
@@ -358,7 +1125,10 @@ if __name__ == '__main__':
     dashboard_names = params.dashboard_uid
     restore_from = params.restore_from
     revision_hosts = params.revision_backup
+    prune_hosts = params.prune
+    diff_hosts = params.diff
     config_file = params.config_file
+    engine = params.engine
 
     #convert to lowercases
     if restore_hosts:
@@ -370,20 +1140,34 @@ if __name__ == '__main__':
     if revision_hosts:
         revision_hosts = [revision_host.lower() for revision_host in revision_hosts]
 
+    if prune_hosts:
+        prune_hosts = [prune_host.lower() for prune_host in prune_hosts]
+
+    if diff_hosts:
+        diff_hosts = [diff_host.lower() for diff_host in diff_hosts]
+
     #set configuration file from params
     if config_file:
         GrafanaBackupManager.grafana_config = config_file
     elif os.path.exists(GrafanaBackupManager.grafana_config) == False:
         GrafanaBackupManager.grafana_config = GrafanaBackupManager.config_path+GrafanaBackupManager.grafana_config
 
-    if backup:
-        backup_grafana_dashboard(backup.lower())
-    elif restore_hosts:
-        restore_grafana_dashboard(restore_hosts, dashboard_names, restore_from)
-    elif create_hosts:
-        create_grafana_dashboard(create_hosts, dashboard_names, restore_from)
-    elif revision_hosts:
-        revison_grafana_backup(revision_hosts, dashboard_names)
-    else:
-        parser.print_help()
-        sys.exit(0)
+    profile = grafana_metrics.profile_run(params.profile) if params.profile else contextlib.nullcontext()
+    with profile:
+        if backup:
+            backup_grafana_dashboard(backup.lower(), engine, params.resume, params.deadline)
+        elif restore_hosts:
+            restore_grafana_dashboard(restore_hosts, dashboard_names, restore_from, engine, params.skip_identical)
+        elif create_hosts:
+            create_grafana_dashboard(create_hosts, dashboard_names, restore_from, engine)
+        elif revision_hosts:
+            revison_grafana_backup(revision_hosts, dashboard_names, engine)
+        elif prune_hosts:
+            prune_grafana_backup(prune_hosts, params.dry_run)
+        elif diff_hosts:
+            diff_grafana_backup(diff_hosts, dashboard_names, restore_from, params.diff_to, params.report)
+        elif params.daemon:
+            run_daemon(engine)
+        else:
+            parser.print_help()
+            sys.exit(0)
@@ -0,0 +1,176 @@
+import grafana_sdk
+import grafana_backup
+from multiprocessing.pool import ThreadPool
+
+ignored_dashboard_keys = grafana_backup.volatile_dashboard_keys+('panels', 'rows')
+ignored_panel_keys = ('targets', 'panels')
+
+class Snapshot:
+
+    def __init__(self, gbm, name):
+        self.gbm = gbm
+        self.name = name
+        self.live = name == grafana_backup.live_snapshot
+
+    def load(self):
+        if self.live:
+            return self.gbm._load_live_snapshot()
+        return self.gbm._load_snapshot(self.name)
+
+    def read(self, entry):
+        if self.live:
+            content = self.gbm.grafana_api.dashboard_details(entry['uid'])
+        else:
+            content = self.gbm._read_snapshot_entry(entry)
+        if not isinstance(content, dict) or 'dashboard' not in content:
+            raise Exception("Could not read dashboard {} from {}".format(entry['file'], self.name))
+        return content
+
+    def resolve(self, entry):
+        # live dashboards and snapshots taken before manifests carry no hash, they are read once here
+        if 'hash' in entry:
+            return entry, None
+        content = self.read(entry)
+        dashboard = content['dashboard']
+        entry = dict(entry, uid=dashboard.get('uid'), version=dashboard.get('version'),
+                     hash=grafana_backup.get_content_hash(content), dashboard_hash=grafana_backup.get_dashboard_hash(content))
+        return entry, content
+
+class SnapshotDiff:
+
+    def __init__(self, gbm, old_name, new_name, dashboard_names=None):
+        self.gbm = gbm
+        self.old = Snapshot(gbm, old_name)
+        self.new = Snapshot(gbm, new_name)
+        self.dashboard_names = dashboard_names
+
+    def run(self):
+        pool = ThreadPool(processes=self.gbm.concurrency)
+        try:
+            old_entries = self.__index(pool, self.old)
+            new_entries = self.__index(pool, self.new)
+            report = {'host': self.gbm.name, 'from': self.old.name, 'to': self.new.name, 'dashboards': len(new_entries), 'unchanged': 0,
+                      'added': [get_entry_summary(new_entries[uid]) for uid in sorted(set(new_entries)-set(old_entries))],
+                      'removed': [get_entry_summary(old_entries[uid]) for uid in sorted(set(old_entries)-set(new_entries))],
+                      'changed': [], 'errors': []}
+            common = sorted(set(old_entries) & set(new_entries))
+            for uid, changes, error in pool.imap(lambda uid: self.__diff_dashboard(uid, old_entries[uid], new_entries[uid]), common):
+                if error:
+                    report['errors'].append({'uid': uid, 'error': error})
+                elif changes:
+                    report['changed'].append(changes)
+                else:
+                    report['unchanged'] += 1
+        finally:
+            pool.close()
+            pool.join()
+        for result in ('added', 'removed', 'changed'):
+            self.gbm._count_dashboards("diff", result, len(report[result]))
+        self.gbm._count_dashboards("diff", "unchanged", report['unchanged'])
+        self.gbm._count_dashboards("diff", "failed", len(report['errors']))
+        return report
+
+    def __index(self, pool, snapshot):
+        entries = [entry for entry in snapshot.load().values() if self.__is_selected(entry)]
+        unresolved = [entry for entry in entries if 'uid' not in entry]
+        if unresolved:
+            entries = [entry for entry in entries if 'uid' in entry]+[entry for entry, content in pool.imap(snapshot.resolve, unresolved)]
+        return {entry['uid']: entry for entry in entries}
+
+    def __is_selected(self, entry):
+        if not self.dashboard_names:
+            return True
+        return grafana_backup.get_backup_file_name(entry['file'])[:-len(".json")] in self.dashboard_names or entry.get('uid', "").lower() in self.dashboard_names
+
+    def __diff_dashboard(self, uid, old_entry, new_entry):
+        try:
+            if is_same_version(old_entry, new_entry):
+                return uid, None, None
+            old_entry, old_content = self.old.resolve(old_entry)
+            new_entry, new_content = self.new.resolve(new_entry)
+            if is_identical(old_entry, new_entry):
+                return uid, None, None
+            old_content = old_content or self.old.read(old_entry)
+            new_content = new_content or self.new.read(new_entry)
+            changes = diff_dashboard(old_content['dashboard'], new_content['dashboard'])
+            if not changes:
+                return uid, None, None
+            changes = dict(get_entry_summary(new_entry), from_version=old_entry.get('version'), to_version=new_entry.get('version'), **changes)
+            return uid, changes, None
+        except Exception as exc:
+            grafana_sdk.get_logger().error("Error comparing dashboard {} on host {}, error : {}".format(uid, self.gbm.name, str(exc)))
+            return uid, None, str(exc)
+
+def is_same_version(old_entry, new_entry):
+    if old_entry.get('version') is None or 'hash' in old_entry and 'hash' in new_entry:
+        return False
+    return old_entry['file'] == new_entry['file'] and old_entry['version'] == new_entry.get('version')
+
+def is_identical(old_entry, new_entry):
+    if old_entry['hash'] == new_entry['hash']:
+        return True
+    return old_entry.get('dashboard_hash') is not None and old_entry.get('dashboard_hash') == new_entry.get('dashboard_hash')
+
+def get_entry_summary(entry):
+    return {'uid': entry['uid'], 'file': entry['file']}
+
+def get_panels(dashboard):
+    panels = []
+    for panel in dashboard.get('panels') or []:
+        panels.append(panel)
+        panels.extend(panel.get('panels') or [])
+    for row in dashboard.get('rows') or []:
+        panels.extend(row.get('panels') or [])
+    return {str(panel['id']) if 'id' in panel else "#{}".format(index): panel for index, panel in enumerate(panels)}
+
+def get_targets(panel):
+    return {target.get('refId') or "#{}".format(index): target for index, target in enumerate(panel.get('targets') or [])}
+
+def get_changed_keys(old, new, ignored_keys=()):
+    return sorted(key for key in set(old) | set(new) if key not in ignored_keys and old.get(key) != new.get(key))
+
+def get_panel_summary(key, panel):
+    return {'id': key, 'title': panel.get('title', "")}
+
+def diff_items(old_items, new_items):
+    added = sorted(set(new_items)-set(old_items))
+    removed = sorted(set(old_items)-set(new_items))
+    changed = sorted(key for key in set(old_items) & set(new_items) if old_items[key] != new_items[key])
+    return added, removed, changed
+
+def diff_panel(key, old_panel, new_panel):
+    changes = get_panel_summary(key, new_panel)
+    changes['settings'] = get_changed_keys(old_panel, new_panel, ignored_panel_keys)
+    old_targets, new_targets = get_targets(old_panel), get_targets(new_panel)
+    added, removed, changed = diff_items(old_targets, new_targets)
+    changes['targets'] = {'added': added, 'removed': removed, 'changed': changed}
+    return changes
+
+def diff_dashboard(old_dashboard, new_dashboard):
+    settings = get_changed_keys(old_dashboard, new_dashboard, ignored_dashboard_keys)
+    old_panels, new_panels = get_panels(old_dashboard), get_panels(new_dashboard)
+    added, removed, changed = diff_items(old_panels, new_panels)
+    changed = [diff_panel(key, old_panels[key], new_panels[key]) for key in changed]
+    changed = [panel for panel in changed if panel['settings'] or any(panel['targets'].values())]
+    if not (settings or added or removed or changed):
+        return None
+    return {'settings': settings,
+            'panels': {'added': [get_panel_summary(key, new_panels[key]) for key in added],
+                       'removed': [get_panel_summary(key, old_panels[key]) for key in removed],
+                       'changed': changed}}
+
+def diff_snapshots(gbm, old_name, new_name, dashboard_names=None):
+    dashboard_names = None if not dashboard_names or "all" in dashboard_names else dashboard_names
+    grafana_sdk.get_logger().info("Comparing {} with {} on host {}".format(old_name, new_name, gbm.name))
+    try:
+        report = SnapshotDiff(gbm, old_name, new_name, dashboard_names).run()
+    except Exception as exc:
+        grafana_sdk.get_logger().error("Error comparing {} with {} on host {}, error : {}".format(old_name, new_name, gbm.name, str(exc)))
+        return None
+    grafana_sdk.get_logger().info("Host {} from {} to {}: {} added, {} removed, {} changed, {} unchanged of {} dashboards.".format(
+        gbm.name, old_name, new_name, len(report['added']), len(report['removed']), len(report['changed']), report['unchanged'], report['dashboards']))
+    for changes in report['changed']:
+        panels = changes['panels']
+        grafana_sdk.get_logger().info("Changed {} version {} -> {}: settings {}, panels +{} -{} ~{}".format(
+            changes['file'], changes['from_version'], changes['to_version'], changes['settings'], len(panels['added']), len(panels['removed']), len(panels['changed'])))
+    return report
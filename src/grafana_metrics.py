@@ -0,0 +1,133 @@
+import os
+import sys
+import time
+import threading
+import grafana_sdk
+from contextlib import contextmanager
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+metric_types = {
+    'grafana_backup_phase_seconds': ('histogram', "Time spent per host in each phase: discovery, fetch, serialize, local_write, s3_put, restore_post."),
+    'grafana_backup_retries_total': ('counter', "Grafana API calls retried per host and phase."),
+    'grafana_backup_bytes_total': ('counter', "Bytes written per host and storage."),
+    'grafana_backup_dashboards_total': ('counter', "Dashboards processed per host, operation and result."),
+    'grafana_backup_pruned_files_total': ('counter', "Files deleted by retention per storage and reason."),
+    'grafana_backup_pruned_bytes_total': ('counter', "Bytes deleted by retention per storage and reason."),
+    'grafana_backup_run_seconds': ('gauge', "Duration of the last run per operation."),
+    'grafana_backup_last_run_timestamp_seconds': ('gauge', "Unix time the last run per operation finished."),
+}
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = dict()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0)+value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = {'buckets': [0]*len(default_buckets), 'sum': 0.0, 'count': 0}
+            for index, bucket in enumerate(default_buckets):
+                if value <= bucket:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items(), key=lambda item: item[0])
+        lines = []
+        rendered = set()
+        for (name, labels), value in values:
+            if name not in rendered:
+                metric_type, metric_help = metric_types.get(name, ('untyped', name))
+                lines.append("# HELP {} {}".format(name, metric_help))
+                lines.append("# TYPE {} {}".format(name, metric_type))
+                rendered.add(name)
+            if isinstance(value, dict):
+                for bucket, count in zip(default_buckets, value['buckets']):
+                    lines.append("{}_bucket{} {}".format(name, get_labels(labels+(('le', str(bucket)),)), count))
+                lines.append("{}_bucket{} {}".format(name, get_labels(labels+(('le', "+Inf"),)), value['count']))
+                lines.append("{}_sum{} {}".format(name, get_labels(labels), value['sum']))
+                lines.append("{}_count{} {}".format(name, get_labels(labels), value['count']))
+            else:
+                lines.append("{}{} {}".format(name, get_labels(labels), value))
+        return "\n".join(lines)+"\n"
+
+registry = MetricsRegistry()
+
+def get_labels(labels):
+    if not labels:
+        return ""
+    return "{"+",".join("{}=\"{}\"".format(key, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for key, value in labels)+"}"
+
+@contextmanager
+def timer(phase, host):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe('grafana_backup_phase_seconds', time.perf_counter()-start, host=host, phase=phase)
+
+@contextmanager
+def profile_run(path):
+    import cProfile
+    import pstats
+    profilers = [cProfile.Profile()]
+    def enable_thread_profiler(frame, event, arg):
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        profilers.append(profiler)
+        profiler.enable()
+    # before 3.12 a cProfile profiler only sees the thread that enabled it
+    if sys.version_info < (3, 12):
+        threading.setprofile(enable_thread_profiler)
+    profilers[0].enable()
+    try:
+        yield
+    finally:
+        profilers[0].disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(path)
+        grafana_sdk.get_logger().info("Stored profile of {} threads under {}".format(len(profilers), path))
+
+def write_textfile(path):
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_path, 'w') as fp:
+        fp.write(registry.render())
+    os.replace(temp_path, path)
+
+def push_to_gateway(gateway_url, job):
+    import requests
+    url = "{}/metrics/job/{}".format(gateway_url.rstrip("/"), job)
+    response = requests.put(url, data=registry.render().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4'}, timeout=10)
+    if response.status_code not in (200, 202):
+        raise Exception("pushgateway returned status_code {}".format(response.status_code))
+
+def export_metrics(metrics_content, operation, run_seconds):
+    registry.set('grafana_backup_run_seconds', run_seconds, operation=operation)
+    registry.set('grafana_backup_last_run_timestamp_seconds', time.time(), operation=operation)
+    if metrics_content.get('textfile'):
+        try:
+            write_textfile(metrics_content['textfile'])
+        except Exception as exc:
+            grafana_sdk.get_logger().error("Error writing metrics textfile {}, error : {}".format(metrics_content['textfile'], str(exc)))
+    if metrics_content.get('pushgateway'):
+        try:
+            push_to_gateway(metrics_content['pushgateway'], metrics_content.get('job', 'grafana_backup'))
+        except Exception as exc:
+            grafana_sdk.get_logger().error("Error pushing metrics to {}, error : {}".format(metrics_content['pushgateway'], str(exc)))
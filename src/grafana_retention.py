@@ -0,0 +1,305 @@
+import io
+import os
+import re
+import time
+from datetime import datetime, timedelta
+import grafana_sdk
+import grafana_metrics
+import grafana_backup
+
+delete_batch_size = 1000
+default_min_object_age_hours = 24
+daily_date_format = "%d-%m-%Y"
+meta_time_format = "%d-%m-%Y %H:%M:%S"
+revision_file_pattern = re.compile(r"^version(\d+)\.json$")
+protected_files = (grafana_backup.manifest_file, ".meta_data", grafana_backup.checkpoint_file, grafana_backup.revision_index_file)
+
+class RetentionPolicy:
+
+    def __init__(self, retention_content):
+        self.keep_daily = retention_content.get('keep_daily')
+        self.keep_weekly = retention_content.get('keep_weekly')
+        self.keep_monthly = retention_content.get('keep_monthly')
+        self.keep_yearly = retention_content.get('keep_yearly')
+        self.max_versions = retention_content.get('max_versions')
+        self.prune_hourly = retention_content.get('prune_hourly', False) == True
+        self.min_object_age = retention_content.get('min_object_age_hours', default_min_object_age_hours)*3600
+
+    def get_kept_dates(self, dates):
+        dates = sorted(dates, reverse=True)
+        kept_dates = set(dates[:self.keep_daily or 0])
+        for keep, period in ((self.keep_weekly, lambda date: date.isocalendar()[:2]),
+                             (self.keep_monthly, lambda date: (date.year, date.month)),
+                             (self.keep_yearly, lambda date: date.year)):
+            periods = set()
+            for date in dates:
+                if not keep or len(periods) >= keep:
+                    break
+                if period(date) not in periods:
+                    periods.add(period(date))
+                    kept_dates.add(date)
+        return kept_dates
+
+    def prunes_daily(self):
+        return any((self.keep_daily, self.keep_weekly, self.keep_monthly, self.keep_yearly))
+
+class LocalStore:
+
+    name = "local"
+
+    def __init__(self, root):
+        self.root = root
+
+    def list_folders(self, prefix):
+        if not os.path.isdir(self.root+prefix):
+            return []
+        return sorted(name for name in os.listdir(self.root+prefix) if os.path.isdir(self.root+prefix+name))
+
+    def list_files(self, prefix):
+        files = []
+        for folder, folder_names, file_names in os.walk(self.root+prefix):
+            for file_name in file_names:
+                path = os.path.join(folder, file_name)
+                files.append((os.path.relpath(path, self.root or ".").replace(os.sep, "/"), os.path.getsize(path), os.path.getmtime(path)))
+        return files
+
+    def read(self, key):
+        with open(self.root+key, 'rb') as fp:
+            return grafana_backup.load_backup_content(fp, key)
+
+    def write(self, key, content):
+        with open(self.root+key, 'wb') as fp:
+            grafana_backup.dump_backup_content(content, fp, key)
+
+    def delete(self, keys):
+        folders = set()
+        for key in keys:
+            try:
+                os.remove(self.root+key)
+                folders.add(os.path.dirname(self.root+key))
+            except OSError as exc:
+                grafana_sdk.get_logger().error("Error deleting {}, error : {}".format(self.root+key, str(exc)))
+        for folder in sorted(folders, key=len, reverse=True):
+            try:
+                while folder and os.path.abspath(folder) != os.path.abspath(self.root or ".") and not os.listdir(folder):
+                    os.rmdir(folder)
+                    folder = os.path.dirname(folder)
+            except OSError:
+                pass
+
+class S3Store:
+
+    name = "s3"
+
+    def __init__(self, client, bucket_name, root):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.root = root
+
+    def list_folders(self, prefix):
+        folders = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket_name, Prefix=self.root+prefix, Delimiter="/"):
+            folders.extend(item['Prefix'][len(self.root+prefix):].rstrip("/") for item in page.get('CommonPrefixes', []))
+        return sorted(folders)
+
+    def list_files(self, prefix):
+        files = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket_name, Prefix=self.root+prefix):
+            files.extend((item['Key'][len(self.root):], item['Size'], item['LastModified'].timestamp()) for item in page.get('Contents', []))
+        return files
+
+    def read(self, key):
+        body = self.client.get_object(Bucket=self.bucket_name, Key=self.root+key)["Body"].read()
+        return grafana_backup.load_backup_content(io.BytesIO(body), key)
+
+    def write(self, key, content):
+        fp = io.BytesIO()
+        grafana_backup.dump_backup_content(content, fp, key)
+        self.client.put_object(Bucket=self.bucket_name, Key=self.root+key, Body=fp.getvalue())
+
+    def delete(self, keys):
+        keys = list(keys)
+        for start in range(0, len(keys), delete_batch_size):
+            batch = [{'Key': self.root+key} for key in keys[start:start+delete_batch_size]]
+            try:
+                response = self.client.delete_objects(Bucket=self.bucket_name, Delete={'Objects': batch, 'Quiet': True})
+                for error in response.get('Errors', []):
+                    grafana_sdk.get_logger().error("Error deleting s3 {}, {}, error : {}".format(self.bucket_name, error.get('Key'), error.get('Message')))
+            except Exception as exc:
+                grafana_sdk.get_logger().error("Error deleting {} keys on s3 {}, error : {}".format(len(batch), self.bucket_name, str(exc)))
+
+class RetentionPruner:
+
+    def __init__(self, store, policy, host_names=None, dry_run=False):
+        self.store = store
+        self.policy = policy
+        self.host_names = host_names
+        self.dry_run = dry_run
+        self.deletions = dict()
+        self.deleted_folders = set()
+        self.manifests = dict()
+
+    def run(self):
+        if self.policy.prunes_daily():
+            self.__prune_daily()
+        if self.policy.prune_hourly:
+            self.__prune_hourly()
+        if self.policy.max_versions:
+            self.__prune_revisions()
+        self.__collect_objects()
+        return self.__apply()
+
+    def __get_hosts(self, prefix):
+        return [host for host in self.store.list_folders(prefix) if self.host_names is None or host in self.host_names]
+
+    def __delete_folder(self, folder_name, reason):
+        self.deleted_folders.add(folder_name)
+        for key, size, modified in self.store.list_files(folder_name):
+            self.deletions[key] = (size, reason)
+
+    def __prune_daily(self):
+        dates = dict()
+        for date_folder in self.store.list_folders("daily/"):
+            try:
+                dates[datetime.strptime(date_folder, daily_date_format).date()] = date_folder
+            except ValueError:
+                grafana_sdk.get_logger().info("Skipping daily folder {} which is not a date.".format(date_folder))
+        kept_dates = self.policy.get_kept_dates(dates)
+        for date, date_folder in dates.items():
+            if date not in kept_dates:
+                for host in self.__get_hosts("daily/{}/".format(date_folder)):
+                    self.__delete_folder("daily/{}/{}/".format(date_folder, host), "daily")
+
+    def __prune_hourly(self):
+        for host in self.__get_hosts("hourly/"):
+            folder_name = "hourly/{}/".format(host)
+            try:
+                manifest = self.store.read(folder_name+grafana_backup.manifest_file)
+                meta_data = self.store.read(folder_name+".meta_data")
+            except Exception:
+                grafana_sdk.get_logger().info("Skipping hourly folder {} without manifest.".format(folder_name))
+                continue
+            if meta_data.get('status', grafana_backup.complete_status) != grafana_backup.complete_status:
+                grafana_sdk.get_logger().info("Skipping hourly folder {} of an incomplete backup.".format(folder_name))
+                continue
+            stored_keys = set(entry.get('key') for entry in manifest.get('dashboards', dict()).values())
+            for key, size, modified in self.store.list_files(folder_name):
+                if key not in stored_keys and os.path.basename(key) not in protected_files:
+                    self.deletions[key] = (size, "hourly")
+
+    def __prune_revisions(self):
+        for host in self.__get_hosts(grafana_backup.revision_folder+"/"):
+            for dashboard_folder in self.store.list_folders("{}/{}/".format(grafana_backup.revision_folder, host)):
+                self.__prune_revision_folder("{}/{}/{}/".format(grafana_backup.revision_folder, host, dashboard_folder))
+
+    def __prune_revision_folder(self, folder_name):
+        versions = dict()
+        revision_files = self.store.list_files(folder_name)
+        for key, size, modified in revision_files:
+            match = revision_file_pattern.match(os.path.basename(grafana_backup.get_backup_file_name(key)))
+            if match:
+                versions.setdefault(int(match.group(1)), []).append((key, size))
+        for version in sorted(versions, reverse=True)[self.policy.max_versions:]:
+            for key, size in versions[version]:
+                self.deletions[key] = (size, "revision")
+        if any(os.path.basename(key) == grafana_backup.manifest_file for key, size, modified in revision_files):
+            manifest = self.store.read(folder_name+grafana_backup.manifest_file)
+            stored_versions = sorted(((int(revision_file_pattern.match(file_name).group(1)), file_name) for file_name in manifest.get('files', dict())
+                                      if revision_file_pattern.match(file_name)), reverse=True)
+            if len(stored_versions) > self.policy.max_versions:
+                for version, file_name in stored_versions[self.policy.max_versions:]:
+                    manifest['files'].pop(file_name)
+                self.manifests[folder_name+grafana_backup.manifest_file] = manifest
+
+    def __get_snapshot_folders(self):
+        folder_names = ["hourly/{}/".format(host) for host in self.store.list_folders("hourly/")]
+        for date_folder in self.store.list_folders("daily/"):
+            folder_names += ["daily/{}/{}/".format(date_folder, host) for host in self.store.list_folders("daily/{}/".format(date_folder))]
+        return [folder_name for folder_name in folder_names if folder_name not in self.deleted_folders]
+
+    def __get_manifest_keys(self):
+        manifest_keys = [folder_name+grafana_backup.manifest_file for folder_name in self.__get_snapshot_folders()]
+        for host in self.store.list_folders(grafana_backup.revision_folder+"/"):
+            manifest_keys += ["{}/{}/{}/{}".format(grafana_backup.revision_folder, host, dashboard_folder, grafana_backup.manifest_file)
+                              for dashboard_folder in self.store.list_folders("{}/{}/".format(grafana_backup.revision_folder, host))]
+        return [key for key in manifest_keys if not any(key.startswith(folder_name) for folder_name in self.deleted_folders)]
+
+    def __get_running_backups(self):
+        running = []
+        started_after = datetime.now()-timedelta(seconds=self.policy.min_object_age)
+        for folder_name in self.__get_snapshot_folders():
+            try:
+                meta_data = self.store.read(folder_name+".meta_data")
+                if meta_data.get('status') == grafana_backup.running_status and datetime.strptime(meta_data['time'], meta_time_format) > started_after:
+                    running.append(folder_name)
+            except Exception:
+                continue
+        return running
+
+    def __collect_objects(self):
+        objects = self.store.list_files(grafana_backup.objects_folder)
+        if not objects:
+            return
+        # objects re-used by a running backup may not be in any manifest yet, backups that stopped longer than the grace period ago are stale
+        running = self.__get_running_backups()
+        if running:
+            grafana_sdk.get_logger().info("Skipping garbage collection of {} while backups are running under {}.".format(grafana_backup.objects_folder, ", ".join(running)))
+            return
+        stored_keys = set()
+        for key in self.__get_manifest_keys():
+            try:
+                manifest = self.manifests[key] if key in self.manifests else self.store.read(key)
+            except FileNotFoundError:
+                continue
+            except Exception as exc:
+                if "NoSuchKey" in str(exc):
+                    continue
+                grafana_sdk.get_logger().error("Could not read {}, skipping garbage collection of {}, error : {}".format(key, grafana_backup.objects_folder, str(exc)))
+                return
+            stored_keys.update(entry.get('key') for entry in manifest.get('dashboards', dict()).values())
+            stored_keys.update(manifest.get('files', dict()).values())
+        oldest_modified = time.time()-self.policy.min_object_age
+        for key, size, modified in objects:
+            if key not in stored_keys and modified < oldest_modified:
+                self.deletions[key] = (size, "objects")
+
+    def __apply(self):
+        report = dict()
+        for key, (size, reason) in sorted(self.deletions.items()):
+            files, total_size = report.get(reason, (0, 0))
+            report[reason] = (files+1, total_size+size)
+            if self.dry_run:
+                grafana_sdk.get_logger().info("Would delete {} from {} ({}).".format(key, self.store.name, reason))
+        for reason, (files, total_size) in sorted(report.items()):
+            grafana_sdk.get_logger().info("{} {} {} files ({} bytes) from {}.".format("Would prune" if self.dry_run else "Pruning", files, reason, total_size, self.store.name))
+        if self.dry_run:
+            return report
+        for key, manifest in self.manifests.items():
+            self.store.write(key, manifest)
+        self.store.delete(self.deletions)
+        for reason, (files, total_size) in report.items():
+            grafana_metrics.registry.inc('grafana_backup_pruned_files_total', files, storage=self.store.name, reason=reason)
+            grafana_metrics.registry.inc('grafana_backup_pruned_bytes_total', total_size, storage=self.store.name, reason=reason)
+        return report
+
+def get_stores(backup_content):
+    stores = []
+    local_backup_content = backup_content.get('local', dict())
+    s3_backup_content = backup_content.get('s3', dict())
+    if local_backup_content.get('enabled', True) == True:
+        stores.append(LocalStore(local_backup_content.get('backup_folder', '')))
+    if s3_backup_content.get('enabled', False) == True:
+        import grafana_s3
+        stores.append(S3Store(grafana_s3.get_s3_client(s3_backup_content.get('max_pool_connections', 50)), s3_backup_content['bucket_name'],
+                              s3_backup_content.get('backup_folder', 'grafana/backup/')))
+    return stores
+
+def prune(backup_content, host_names=None, dry_run=False):
+    policy = RetentionPolicy(backup_content.get('retention', dict()))
+    reports = dict()
+    for store in get_stores(backup_content):
+        try:
+            reports[store.name] = RetentionPruner(store, policy, host_names, dry_run).run()
+        except Exception as exc:
+            grafana_sdk.get_logger().error("Error pruning {} backups, error : {}".format(store.name, str(exc)))
+    return reports
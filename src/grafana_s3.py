@@ -0,0 +1,91 @@
+import queue
+import threading
+import collections
+import boto3
+import grafana_sdk
+import grafana_metrics
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+
+s3_client = None
+s3_client_lock = threading.Lock()
+s3_writer = None
+
+def get_s3_client(max_pool_connections=50):
+    global s3_client
+    with s3_client_lock:
+        if s3_client is None:
+            s3_client = boto3.session.Session().client('s3', config=Config(max_pool_connections=max_pool_connections, retries={'max_attempts': 5}))
+        return s3_client
+
+def get_s3_writer(client, bucket_name, workers=8, queue_size=32, multipart_threshold=8*1024*1024):
+    global s3_writer
+    with s3_client_lock:
+        if s3_writer is None:
+            s3_writer = S3Writer(client, bucket_name, workers, queue_size, multipart_threshold)
+        return s3_writer
+
+def close_s3_writer():
+    global s3_writer
+    with s3_client_lock:
+        writer, s3_writer = s3_writer, None
+    if writer is not None:
+        writer.close()
+
+class S3Writer:
+
+    def __init__(self, client, bucket_name, workers=8, queue_size=32, multipart_threshold=8*1024*1024, name=None):
+        self.client = client
+        self.name = name or bucket_name
+        self.bucket_name = bucket_name
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_threshold, use_threads=False)
+        self.upload_queue = queue.Queue(maxsize=queue_size)
+        # one writer drains the uploads of every host, pending uploads and failures are tracked per host
+        self.pending = collections.Counter()
+        self.errors = dict()
+        self.condition = threading.Condition()
+        self.workers = [threading.Thread(target=self.__worker, name="s3-writer-{}".format(i), daemon=True) for i in range(max(1, workers))]
+        for worker in self.workers:
+            worker.start()
+
+    def put(self, key, fp, name=None):
+        with self.condition:
+            self.pending[name] += 1
+        self.upload_queue.put((key, fp, name))
+
+    def __worker(self):
+        while True:
+            key, fp, name = self.upload_queue.get()
+            error = None
+            try:
+                if key is None:
+                    return
+                size = fp.seek(0, 2)
+                fp.seek(0)
+                with grafana_metrics.timer("s3_put", name or self.name):
+                    self.client.upload_fileobj(fp, self.bucket_name, key, Config=self.transfer_config)
+                grafana_metrics.registry.inc('grafana_backup_bytes_total', size, host=name or self.name, storage="s3")
+            except Exception as exc:
+                grafana_sdk.get_logger().error("Error storing backup on s3 {}, {}, error : {}".format(self.bucket_name, key, str(exc)))
+                error = str(exc)
+            finally:
+                if fp is not None:
+                    fp.close()
+                if key is not None:
+                    with self.condition:
+                        if error is not None:
+                            self.errors.setdefault(name, []).append((key, error))
+                        self.pending[name] -= 1
+                        self.condition.notify_all()
+                self.upload_queue.task_done()
+
+    def flush(self, name=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending[name] == 0)
+            return self.errors.pop(name, [])
+
+    def close(self):
+        for _ in self.workers:
+            self.upload_queue.put((None, None, None))
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,171 @@
+import time
+import threading
+import collections
+import grafana_sdk
+from datetime import datetime, timedelta
+from concurrent.futures import Future
+
+pending_per_worker = 4
+cron_fields = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+class FairQueue:
+
+    def __init__(self):
+        self.queues = dict()
+        self.finish_times = dict()
+        self.virtual_time = 0.0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, host, weight, item):
+        # weighted fair queueing: every item is tagged with the virtual time it would finish at on a
+        # host-weighted share of the workers and items are served in tag order across hosts
+        finish_time = max(self.virtual_time, self.finish_times.get(host, 0.0))+1.0/max(weight, 0.001)
+        self.finish_times[host] = finish_time
+        self.queues.setdefault(host, collections.deque()).append((finish_time, item))
+        self.size += 1
+
+    def pop(self, eligible=None):
+        selected = None
+        for host, queue in self.queues.items():
+            if queue and (eligible is None or eligible(host)) and (selected is None or queue[0][0] < self.queues[selected][0][0]):
+                selected = host
+        if selected is None:
+            return None
+        finish_time, item = self.queues[selected].popleft()
+        self.virtual_time = max(self.virtual_time, finish_time)
+        self.size -= 1
+        return selected, item
+
+class BackupScheduler:
+
+    def __init__(self, workers):
+        self.condition = threading.Condition()
+        self.queue = FairQueue()
+        self.running = dict()
+        self.pending = dict()
+        self.limits = dict()
+        self.closed = False
+        self.workers = [threading.Thread(target=self.__worker, name="scheduler-{}".format(i), daemon=True) for i in range(max(1, workers))]
+        for worker in self.workers:
+            worker.start()
+
+    def map(self, host, func, items, limit, weight=1):
+        with self.condition:
+            self.limits[host] = max(1, limit)
+        futures = []
+        for item in items:
+            future = Future()
+            with self.condition:
+                # bounded stream: only pull the next dashboard once the host has room for it
+                while self.pending.get(host, 0) >= self.limits[host]*pending_per_worker:
+                    self.condition.wait()
+                self.pending[host] = self.pending.get(host, 0)+1
+                self.queue.push(host, weight, (func, item, future))
+                self.condition.notify_all()
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def __is_eligible(self, host):
+        return self.running.get(host, 0) < self.limits.get(host, 1)
+
+    def __worker(self):
+        while True:
+            with self.condition:
+                task = self.queue.pop(self.__is_eligible)
+                while task is None:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                    task = self.queue.pop(self.__is_eligible)
+                host, (func, item, future) = task
+                self.running[host] = self.running.get(host, 0)+1
+            try:
+                future.set_result(func(item))
+            except Exception as exc:
+                future.set_exception(exc)
+            finally:
+                with self.condition:
+                    self.running[host] -= 1
+                    self.pending[host] -= 1
+                    self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+class RunDeadline:
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.deadline = time.monotonic()+seconds
+        self.reported = False
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        return self.deadline-time.monotonic()
+
+    def expired(self):
+        if time.monotonic() < self.deadline:
+            return False
+        with self.lock:
+            if not self.reported:
+                self.reported = True
+                grafana_sdk.get_logger().error("Run deadline of {} seconds reached, skipping the remaining dashboards.".format(self.seconds))
+        return True
+
+class CronSchedule:
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != len(cron_fields):
+            raise Exception("Invalid schedule {}, expected minute hour day month weekday".format(expression))
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [get_cron_values(field, low, high) for field, (low, high) in zip(fields, cron_fields)]
+        self.weekdays = set(weekday % 7 for weekday in self.weekdays)
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def __matches_day(self, date):
+        if date.month not in self.months:
+            return False
+        day_matches = date.day in self.days
+        weekday_matches = (date.weekday()+1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_matches and weekday_matches
+        return day_matches or weekday_matches
+
+    def next_time(self, after):
+        after = after.replace(second=0, microsecond=0)
+        for day_offset in range(367*4):
+            date = after.date()+timedelta(days=day_offset)
+            if not self.__matches_day(date):
+                continue
+            for hour in sorted(self.hours):
+                for minute in sorted(self.minutes):
+                    run_at = datetime(date.year, date.month, date.day, hour, minute)
+                    if run_at > after:
+                        return run_at
+        raise Exception("Schedule {} never runs".format(self.expression))
+
+def get_cron_values(field, low, high):
+    values = set()
+    for part in field.split(","):
+        value_range, _, step = part.partition("/")
+        if value_range == "*":
+            start, end = low, high
+        elif "-" in value_range:
+            start, end = [int(value) for value in value_range.split("-")]
+        else:
+            start = end = int(value_range)
+            if step:
+                end = high
+        if start < low or end > high or start > end:
+            raise Exception("Invalid schedule field {}".format(field))
+        values.update(range(start, end+1, int(step or 1)))
+    return values
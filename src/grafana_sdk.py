@@ -1,84 +1,206 @@
 import requests
 import sys
+import time
+import random
 import logging
+import threading
+import grafana_metrics
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+retry_status_codes = (429, 500, 502, 503, 504)
+# POSTs that reached Grafana may have been applied, they are only retried when Grafana rejected them
+unapplied_status_codes = (429,)
+idempotent_methods = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+default_max_backoff = 60
+
+logger = logging.getLogger("grafana_backup")
 
 def get_logger():
-    logging.basicConfig(stream=sys.stdout, level="INFO",
+    if not logging.root.handlers:
+        logging.basicConfig(stream=sys.stdout, level="INFO",
                             format="[%(asctime)s] %(levelname)s [%(threadName)s] [%(filename)s:%(funcName)s:%(lineno)s] %(message)s",
                             datefmt='%Y-%m-%dT%H:%M:%S')
-    logger = logging.getLogger("grafana_backup")
     return logger
 
+def get_restore_result(backup_file, response):
+    if isinstance(response, dict) and response.get('status') == 'success':
+        return backup_file, True, None
+    return backup_file, False, str(response)
+
+def get_retry_status_codes(method):
+    if method in idempotent_methods:
+        return retry_status_codes
+    return unapplied_status_codes
+
+def is_unsent_error(exc):
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    return bool(exc.args) and isinstance(getattr(exc.args[0], 'reason', None), NewConnectionError)
+
+def get_retry_delay(attempt, backoff_factor, retry_after=None, max_backoff=default_max_backoff):
+    if retry_after:
+        try:
+            return min(max_backoff, max(0, float(retry_after)))
+        except ValueError:
+            try:
+                return min(max_backoff, max(0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+            except (TypeError, ValueError):
+                pass
+    return min(max_backoff, random.uniform(0, backoff_factor * (2 ** attempt)))
+
+def is_past_deadline(deadline, delay):
+    return deadline is not None and deadline.remaining() < delay
+
+class RateLimiter:
+
+    def __init__(self, rate):
+        self.interval = 1.0/rate if rate else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        if not self.interval:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        return slot - now
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
 class GrafanaApi:
 
-    def __init__(self, grafana_url, api_key):
+    def __init__(self, grafana_url, api_key, pool_size=10, connect_timeout=5, read_timeout=30,
+                 max_retries=3, backoff_factor=0.5, rate_limit=None, page_size=1000, name=None, max_backoff=default_max_backoff):
         self.grafana_url = grafana_url
+        self.name = name or grafana_url
         self.api_key = api_key
+        self.page_size = page_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.deadline = None
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(self.__get_header())
 
     def __get_header(self):
         return {'Authorization':'Bearer {}'.format(self.api_key)}
 
+    def __request(self, method, url, phase="fetch", **kwargs):
+        with grafana_metrics.timer(phase, self.name):
+            return self.__retry_request(method, url, phase, **kwargs)
+
+    def __retry_request(self, method, url, phase, **kwargs):
+        attempt = 0
+        while True:
+            self.rate_limiter.wait()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                if attempt >= self.max_retries or not (method in idempotent_methods or is_unsent_error(exc)):
+                    raise
+                delay = get_retry_delay(attempt, self.backoff_factor, max_backoff=self.max_backoff)
+                if is_past_deadline(self.deadline, delay):
+                    get_logger().error("API Call Failed, API: {}, error: {}, not retrying past the run deadline".format(url, str(exc)))
+                    raise
+                get_logger().warning("API Call Failed, API: {}, error: {}, retrying in {:.2f}s".format(url, str(exc), delay))
+            else:
+                if response.status_code not in get_retry_status_codes(method) or attempt >= self.max_retries:
+                    return response
+                delay = get_retry_delay(attempt, self.backoff_factor, response.headers.get('Retry-After'), self.max_backoff)
+                if is_past_deadline(self.deadline, delay):
+                    get_logger().error("API Call Error, API: {}, status_code: {}, not retrying past the run deadline".format(url, response.status_code))
+                    return response
+                get_logger().warning("API Call Error, API: {}, status_code: {}, retrying in {:.2f}s".format(url, response.status_code, delay))
+            grafana_metrics.registry.inc('grafana_backup_retries_total', host=self.name, phase=phase)
+            attempt += 1
+            time.sleep(delay)
+
+    def close(self):
+        self.session.close()
+
     def search_db(self):
-        url = "{}/api/search?type=dash-db".format(self.grafana_url)
-        get_logger().info("Request To : URL {}".format(url))
-        response = requests.get(url, headers=self.__get_header())
-        if response.status_code != 200:
-            get_logger().error("API Call Error, API: {}, status_code: {}, error: {}".format(url, response.status_code, response.text))
-        return response.json()
+        page = 1
+        while True:
+            url = "{}/api/search?type=dash-db&limit={}&page={}".format(self.grafana_url, self.page_size, page)
+            get_logger().debug("Request To : URL {}".format(url))
+            response = self.__request('GET', url, phase="discovery")
+            if response.status_code != 200:
+                get_logger().error("API Call Error, API: {}, status_code: {}, error: {}".format(url, response.status_code, response.text))
+                raise Exception("Error searching dashboards on "+self.grafana_url)
+            dashboards = response.json()
+            for dashboard in dashboards:
+                yield dashboard
+            if len(dashboards) < self.page_size:
+                return
+            page += 1
 
     def search_folder(self, folder_id):
         url = "{}/api/folders/id/{}".format(self.grafana_url, folder_id)
-        get_logger().info("Request To : URL {}".format(url))
-        response = requests.get(url, headers=self.__get_header())
+        get_logger().debug("Request To : URL {}".format(url))
+        response = self.__request('GET', url, phase="folder")
         return response
 
     def create_folder(self, folder_title):
         url = "{}/api/folders".format(self.grafana_url)
         data = { "title": folder_title, }
-        get_logger().info("Request To : URL {}".format(url))
-        response = requests.post(url, data=data, headers=self.__get_header())
+        get_logger().debug("Request To : URL {}".format(url))
+        response = self.__request('POST', url, phase="folder", data=data)
         if response.status_code != 200:
             get_logger().error("API Call Error, API: {}, status_code: {}, error: {}".format(url, response.status_code, response.text))
         return response.json()
 
     def dashboard_details(self, dashboard_uid):
         url = "{}/api/dashboards/uid/{}".format(self.grafana_url, dashboard_uid)
-        get_logger().info("Request To : URL {}".format(url))
-        response = requests.get(url,  headers=self.__get_header())
+        get_logger().debug("Request To : URL {}".format(url))
+        response = self.__request('GET', url)
         if response.status_code != 200:
             get_logger().error("API Call Error, API: {}, status_code: {}, error: {}".format(url, response.status_code, response.text))
+            raise Exception("Error fetching dashboard {} on {}, status_code {}".format(dashboard_uid, self.grafana_url, response.status_code))
         return response.json()
 
     def restore(self, json_content):
-        headers=self.__get_header()
-        headers['Content-Type'] = 'application/json'
+        headers = {'Content-Type': 'application/json'}
         url = "{}/api/dashboards/db/".format(self.grafana_url)
-        get_logger().info("Request To : URL {}".format(url))
-        response = requests.post(url, data=json_content, headers=headers)
+        get_logger().debug("Request To : URL {}".format(url))
+        response = self.__request('POST', url, phase="restore_post", data=json_content, headers=headers)
         if response.status_code != 200:
             get_logger().error("API Call Error, API: {}, status_code: {}, error: {}".format(url, response.status_code, response.text))
         return response.json()
 
     def dashboard_versions(self, dashboard_id):
         url = "{}/api/dashboards/id/{}/versions".format(self.grafana_url, dashboard_id)
-        get_logger().info("Request To : URL {}".format(url))
-        response = requests.get(url, headers=self.__get_header())
+        get_logger().debug("Request To : URL {}".format(url))
+        response = self.__request('GET', url)
         if response.status_code != 200:
             get_logger().error("API Call Error, API: {}, status_code: {}, error: {}".format(url, response.status_code, response.text))
+            raise Exception("Error fetching versions of dashboard {} on {}, status_code {}".format(dashboard_id, self.grafana_url, response.status_code))
         return response.json()
 
     def dashboard_version_details(self, dashboard_id, version_no):
         url = "{}/api/dashboards/id/{}/versions/{}".format(self.grafana_url, dashboard_id, version_no)
-        get_logger().info("Request To : URL {}".format(url))
-        response = requests.get(url, headers=self.__get_header())
+        get_logger().debug("Request To : URL {}".format(url))
+        response = self.__request('GET', url)
         if response.status_code != 200:
             get_logger().error("API Call Error, API: {}, status_code: {}, error: {}".format(url, response.status_code, response.text))
+            raise Exception("Error fetching version {} of dashboard {} on {}, status_code {}".format(version_no, dashboard_id, self.grafana_url, response.status_code))
         return response.json()
 
     def tags(self):
         url = "{}/api/dashboards/tags".format(self.grafana_url)
-        get_logger().info("Request To : URL {}".format(url))
-        response = requests.get(url,  headers=self.__get_header())
+        get_logger().debug("Request To : URL {}".format(url))
+        response = self.__request('GET', url)
         if response.status_code != 200:
             get_logger().error("API Call Error, API: {}, status_code: {}, error: {}".format(url, response.status_code, response.text))
         return response.json()
@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import pytest
+import threading
+
+root_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root_folder, "src"))
+sys.path.insert(0, os.path.join(root_folder, "bench"))
+
+try:
+    from moto import mock_aws
+except ImportError:
+    from moto import mock_s3 as mock_aws
+
+@pytest.fixture
+def bucket_name():
+    return "grafana-test"
+
+@pytest.fixture
+def s3_client(monkeypatch, bucket_name):
+    import grafana_s3
+    for key in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(key, "test")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(grafana_s3, "s3_client", None)
+    monkeypatch.setattr(grafana_s3, "s3_writer", None)
+    with mock_aws():
+        client = grafana_s3.get_s3_client()
+        client.create_bucket(Bucket=bucket_name)
+        yield client
+        grafana_s3.close_s3_writer()
+
+@pytest.fixture
+def grafana_server():
+    import mock_grafana
+    class FailingHandler(mock_grafana.MockGrafanaHandler):
+        def simulate(self):
+            with self.server.lock:
+                self.server.requests.append((self.command, self.path.split("?")[0]))
+            if self.path.split("?")[0] in self.server.failing_paths:
+                if self.server.retry_after is not None:
+                    self.send_response(429)
+                    self.send_header("Retry-After", self.server.retry_after)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return False
+                self.send_json(500, {"message": "boom"})
+                return False
+            return super().simulate()
+    server = mock_grafana.MockGrafanaServer(("127.0.0.1", 0))
+    server.RequestHandlerClass = FailingHandler
+    server.failing_paths = set()
+    server.retry_after = None
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def backup_config(tmp_path, monkeypatch, grafana_server, bucket_name):
+    import grafana_backup
+    def write_config(s3=False, **backup):
+        config_file = str(tmp_path/"grafana_urls.json")
+        content = {"grafana_urls": [{"name": "h1", "url": "http://127.0.0.1:{}".format(grafana_server.server_address[1]), "api_key": "test",
+                                     "max_retries": 1, "backoff_factor": 0}],
+                   "backup": dict({"local": {"enabled": not s3, "backup_folder": str(tmp_path/"backup")+os.sep},
+                                   "s3": {"enabled": s3, "bucket_name": bucket_name, "backup_folder": "grafana/backup/"}}, **backup)}
+        with open(config_file, 'w') as fp:
+            json.dump(content, fp)
+        monkeypatch.setattr(grafana_backup.GrafanaBackupManager, "grafana_config", config_file)
+        return content
+    return write_config
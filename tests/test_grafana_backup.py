@@ -0,0 +1,126 @@
+import os
+import json
+import pytest
+import grafana_backup
+
+engines = [grafana_backup.thread_engine, grafana_backup.async_engine]
+
+def read_s3(client, bucket_name, key):
+    return json.loads(client.get_object(Bucket=bucket_name, Key="grafana/backup/"+key)["Body"].read())
+
+def read_local(backup_folder, key):
+    with open(os.path.join(backup_folder, key)) as fp:
+        return json.load(fp)
+
+def read_checkpoint(client, bucket_name, key):
+    return grafana_backup.CheckpointJournal.loads(client.get_object(Bucket=bucket_name, Key="grafana/backup/"+key)["Body"].read().decode('utf-8'))
+
+@pytest.mark.parametrize("engine", engines)
+def test_checkpoint_upload_failure_keeps_backup_incomplete(engine, monkeypatch, s3_client, bucket_name, grafana_server, backup_config):
+    grafana_server.dashboards = 150
+    backup_config(s3=True)
+    failing = [True]
+    upload_fileobj = s3_client.upload_fileobj
+    def failing_upload_fileobj(fp, bucket, key, **kwargs):
+        if failing and "/dashboard5_" in key:
+            raise Exception("injected failure")
+        return upload_fileobj(fp, bucket, key, **kwargs)
+    monkeypatch.setattr(s3_client, "upload_fileobj", failing_upload_fileobj)
+
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type, engine)
+    assert read_s3(s3_client, bucket_name, "hourly/h1/.meta_data")['status'] == grafana_backup.running_status
+    assert "u5" not in read_s3(s3_client, bucket_name, "hourly/h1/.manifest")['dashboards']
+    checkpoint = read_checkpoint(s3_client, bucket_name, "hourly/h1/.checkpoint")
+    assert "u5" not in checkpoint and len(checkpoint) == 149
+
+    failing.clear()
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type, engine, resume=True)
+    assert read_s3(s3_client, bucket_name, "hourly/h1/.meta_data")['status'] == grafana_backup.complete_status
+    dashboards = read_s3(s3_client, bucket_name, "hourly/h1/.manifest")['dashboards']
+    assert len(dashboards) == 150
+    assert read_s3(s3_client, bucket_name, dashboards["u5"]['key'])['dashboard']['uid'] == "u5"
+
+@pytest.mark.parametrize("engine", engines)
+def test_failed_dashboard_fetch_keeps_previous_copy(engine, tmp_path, grafana_server, backup_config):
+    backup_folder = str(tmp_path/"backup")
+    backup_config()
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type, engine)
+    previous_copy = read_local(backup_folder, "hourly/h1/dashboard3_u3.json")
+
+    grafana_server.failing_paths.add("/api/dashboards/uid/u3")
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type, engine)
+    assert read_local(backup_folder, "hourly/h1/dashboard3_u3.json") == previous_copy
+    assert read_local(backup_folder, "hourly/h1/.meta_data")['status'] == grafana_backup.running_status
+    assert "u3" in read_local(backup_folder, "hourly/h1/.manifest")['dashboards']
+    gbm = grafana_backup.get_backup_managers()[0]
+    assert [result[:2] for result in gbm.restore_dashboard("h1", ["dashboard3_u3"], grafana_backup.hourly_backup_type)] == [(os.path.join(backup_folder, "hourly/h1/dashboard3_u3.json"), True)]
+    assert len(gbm.restore_dashboard("h1", ["all"], grafana_backup.hourly_backup_type)) == grafana_server.dashboards
+
+def test_deleted_dashboard_stays_restorable(tmp_path, grafana_server, backup_config):
+    backup_folder = str(tmp_path/"backup")
+    backup_config()
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type)
+    grafana_server.dashboards = 9
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type)
+    assert "u10" not in read_local(backup_folder, "hourly/h1/.manifest")['dashboards']
+    gbm = grafana_backup.get_backup_managers()[0]
+    results = gbm.restore_dashboard("h1", ["dashboard10_u10"], grafana_backup.hourly_backup_type)
+    assert [result[:2] for result in results] == [(os.path.join(backup_folder, "hourly/h1/dashboard10_u10.json"), True)]
+
+@pytest.mark.parametrize("engine", engines)
+def test_failed_revision_is_fetched_again(engine, tmp_path, grafana_server, backup_config):
+    revision_folder = str(tmp_path/"backup"/"revision"/"h1"/"dashboard1_u1")
+    backup_config()
+    grafana_server.failing_paths.add("/api/dashboards/id/1/versions/1")
+    grafana_backup.revison_grafana_backup(["all"], ["all"], engine)
+    assert not os.path.exists(os.path.join(revision_folder, "version1.json"))
+    assert not os.path.exists(os.path.join(revision_folder, ".meta_data"))
+    assert read_local(str(tmp_path/"backup"), "revision/h1/dashboard2_u2/.meta_data")['version'] == 3
+
+    grafana_server.failing_paths.clear()
+    grafana_backup.revison_grafana_backup(["all"], ["all"], engine)
+    assert read_local(revision_folder, "version1.json")['version'] == 1
+    assert read_local(revision_folder, ".meta_data")['version'] == 3
+
+@pytest.mark.parametrize("engine", engines)
+def test_revisions_are_committed_in_batches(engine, tmp_path, grafana_server, backup_config):
+    grafana_server.dashboards = grafana_backup.commit_batch_size*2+50
+    backup_config()
+    grafana_backup.revison_grafana_backup(["all"], ["all"], engine)
+    revision_index = read_local(str(tmp_path/"backup"), "revision/h1/.index")['dashboards']
+    assert len(revision_index) == grafana_server.dashboards
+    assert all(meta_data['version'] == 3 for meta_data in revision_index.values())
+
+def test_warm_async_engine_keeps_sessions(monkeypatch, grafana_server, backup_config):
+    backup_config()
+    monkeypatch.setattr(grafana_backup, "warm_managers", dict())
+    try:
+        grafana_backup.revison_grafana_backup(["all"], ["all"], grafana_backup.async_engine)
+        sessions = dict(grafana_backup.warm_engine.sessions)
+        grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type, grafana_backup.async_engine)
+        assert grafana_backup.warm_engine.sessions == sessions
+        assert not any(session.closed for gbm, session in sessions.values())
+    finally:
+        grafana_backup.close_warm_managers()
+    assert grafana_backup.warm_engine is None
+    assert all(session.closed for gbm, session in sessions.values())
+
+def test_one_shot_runs_close_managers(monkeypatch, grafana_server, backup_config):
+    backup_config()
+    closed = []
+    monkeypatch.setattr(grafana_backup.GrafanaBackupManager, "close", lambda gbm: closed.append(gbm.name))
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type)
+    grafana_backup.restore_grafana_dashboard(["all"], ["all"])
+    grafana_backup.diff_grafana_backup(["all"])
+    assert closed == ["h1"]*3
+
+@pytest.mark.parametrize("s3", [False, True])
+def test_first_runs_log_no_errors(s3, request, caplog, grafana_server, backup_config):
+    if s3:
+        request.getfixturevalue("s3_client")
+    backup_config(s3=s3, layout=grafana_backup.cas_layout)
+    with caplog.at_level("INFO", logger="grafana_backup"):
+        grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type)
+        grafana_backup.revison_grafana_backup(["all"], ["all"])
+    assert [record.getMessage() for record in caplog.records if record.levelname == "ERROR"] == []
+    assert any("not present" in record.getMessage() for record in caplog.records)
@@ -0,0 +1,150 @@
+import os
+import glob
+import json
+import time
+import pytest
+from datetime import date, datetime, timedelta
+import grafana_backup
+import grafana_retention
+
+def write_local(backup_folder, key, content):
+    os.makedirs(os.path.dirname(os.path.join(backup_folder, key)), exist_ok=True)
+    with open(os.path.join(backup_folder, key), 'w') as fp:
+        json.dump(content, fp)
+
+def read_local(backup_folder, key):
+    with open(os.path.join(backup_folder, key)) as fp:
+        return json.load(fp)
+
+def get_objects(backup_folder):
+    return sorted(os.path.relpath(path, backup_folder).replace(os.sep, "/") for path in glob.glob(os.path.join(backup_folder, "objects", "*", "*")))
+
+def age_objects(backup_folder, hours=48):
+    modified = time.time()-hours*3600
+    for key in get_objects(backup_folder):
+        os.utime(os.path.join(backup_folder, key), (modified, modified))
+
+def test_kept_dates():
+    dates = [date(2020, 12, 31)-timedelta(days=day) for day in range(400)]
+    assert grafana_retention.RetentionPolicy({'keep_daily': 3}).get_kept_dates(dates) == set(dates[:3])
+    assert grafana_retention.RetentionPolicy({'keep_weekly': 2}).get_kept_dates(dates) == {date(2020, 12, 31), date(2020, 12, 27)}
+    assert grafana_retention.RetentionPolicy({'keep_monthly': 2}).get_kept_dates(dates) == {date(2020, 12, 31), date(2020, 11, 30)}
+    assert grafana_retention.RetentionPolicy({'keep_yearly': 3}).get_kept_dates(dates) == {date(2020, 12, 31), date(2019, 12, 31)}
+    assert grafana_retention.RetentionPolicy({'keep_daily': 1, 'keep_monthly': 1}).get_kept_dates(dates) == {date(2020, 12, 31)}
+    assert not grafana_retention.RetentionPolicy({'max_versions': 1}).prunes_daily()
+
+@pytest.mark.parametrize("dry_run", [False, True])
+def test_prune_daily_folders(dry_run, tmp_path, backup_config):
+    backup_folder = str(tmp_path/"backup")
+    backup_config(retention={'keep_daily': 2, 'keep_monthly': 2})
+    date_folders = ["01-01-2021", "31-01-2021", "14-02-2021", "15-02-2021", "16-02-2021", "not-a-date"]
+    for date_folder in date_folders:
+        write_local(backup_folder, "daily/{}/h1/dashboard1_u1.json".format(date_folder), {})
+    reports = grafana_backup.prune_grafana_backup(["all"], dry_run)
+    assert reports['local']['daily'] == (2, 4)
+    kept_folders = date_folders if dry_run else ["31-01-2021", "15-02-2021", "16-02-2021", "not-a-date"]
+    assert sorted(os.listdir(os.path.join(backup_folder, "daily"))) == sorted(kept_folders)
+
+def test_prune_daily_folders_of_selected_hosts(tmp_path, backup_config):
+    backup_folder = str(tmp_path/"backup")
+    backup_config(retention={'keep_daily': 1})
+    for date_folder in ("01-01-2021", "02-01-2021"):
+        for host in ("h1", "h2"):
+            write_local(backup_folder, "daily/{}/{}/dashboard1_u1.json".format(date_folder, host), {})
+    grafana_backup.prune_grafana_backup(["h1"])
+    assert os.listdir(os.path.join(backup_folder, "daily", "01-01-2021")) == ["h2"]
+    assert sorted(os.listdir(os.path.join(backup_folder, "daily", "02-01-2021"))) == ["h1", "h2"]
+
+@pytest.mark.parametrize("layout", [grafana_backup.files_layout, grafana_backup.cas_layout])
+def test_prune_revisions_keeps_max_versions(layout, tmp_path, grafana_server, backup_config):
+    backup_folder = str(tmp_path/"backup")
+    revision_folder = "revision/h1/dashboard1_u1/"
+    grafana_server.versions = 5
+    backup_config(layout=layout, retention={'max_versions': 2, 'min_object_age_hours': 0})
+    grafana_backup.revison_grafana_backup(["all"], ["all"])
+    grafana_backup.prune_grafana_backup(["all"])
+    if layout == grafana_backup.files_layout:
+        assert sorted(glob.glob(os.path.join(backup_folder, revision_folder, "version*"))) == [os.path.join(backup_folder, revision_folder, "version{}.json".format(version)) for version in (4, 5)]
+    else:
+        stored_files = read_local(backup_folder, revision_folder+grafana_backup.manifest_file)['files']
+        assert sorted(stored_files) == ["version4.json", "version5.json"]
+        assert all(os.path.exists(os.path.join(backup_folder, key)) for key in stored_files.values())
+        assert len(get_objects(backup_folder)) == 2*grafana_server.dashboards
+    assert read_local(backup_folder, revision_folder+".meta_data")['version'] == 5
+
+def test_prune_hourly_removes_unlisted_files(tmp_path, grafana_server, backup_config):
+    backup_folder = str(tmp_path/"backup")
+    backup_config(retention={'prune_hourly': True})
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type)
+    write_local(backup_folder, "hourly/h1/removed_u99.json", {})
+    meta_data = read_local(backup_folder, "hourly/h1/.meta_data")
+    write_local(backup_folder, "hourly/h1/.meta_data", dict(meta_data, status=grafana_backup.running_status))
+    grafana_backup.prune_grafana_backup(["all"])
+    assert os.path.exists(os.path.join(backup_folder, "hourly/h1/removed_u99.json"))
+
+    write_local(backup_folder, "hourly/h1/.meta_data", meta_data)
+    reports = grafana_backup.prune_grafana_backup(["all"])
+    assert reports['local']['hourly'][0] == 1
+    assert not os.path.exists(os.path.join(backup_folder, "hourly/h1/removed_u99.json"))
+    assert len(glob.glob(os.path.join(backup_folder, "hourly/h1/*.json"))) == grafana_server.dashboards
+    assert os.path.exists(os.path.join(backup_folder, "hourly/h1/.manifest"))
+
+def test_collect_objects_keeps_referenced_and_recent_objects(tmp_path, grafana_server, backup_config):
+    backup_folder = str(tmp_path/"backup")
+    backup_config(layout=grafana_backup.cas_layout)
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type)
+    referenced = get_objects(backup_folder)
+    write_local(backup_folder, "objects/aa/unreferenced.json", {})
+    age_objects(backup_folder)
+    write_local(backup_folder, "objects/bb/recent.json", {})
+    reports = grafana_backup.prune_grafana_backup(["all"])
+    assert reports['local']['objects'][0] == 1
+    assert get_objects(backup_folder) == sorted(referenced+["objects/bb/recent.json"])
+
+def test_collect_objects_skipped_while_backup_runs(monkeypatch, tmp_path, grafana_server, backup_config):
+    backup_folder = str(tmp_path/"backup")
+    backup_config(layout=grafana_backup.cas_layout)
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type)
+    age_objects(backup_folder)
+    write_local(backup_folder, "hourly/h1/.manifest", {'dashboards': dict()})
+    store_manifest = grafana_backup.GrafanaBackupManager._store_manifest
+    def prune_before_store_manifest(gbm, folder_name, entries):
+        grafana_backup.prune_grafana_backup(["all"])
+        return store_manifest(gbm, folder_name, entries)
+    monkeypatch.setattr(grafana_backup.GrafanaBackupManager, "_store_manifest", prune_before_store_manifest)
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type)
+    dashboards = read_local(backup_folder, "hourly/h1/.manifest")['dashboards']
+    assert len(dashboards) == grafana_server.dashboards
+    assert all(os.path.exists(os.path.join(backup_folder, entry['key'])) for entry in dashboards.values())
+
+    stale_time = (datetime.now()-timedelta(days=2)).strftime(grafana_retention.meta_time_format)
+    write_local(backup_folder, "hourly/h1/.meta_data", {'time': stale_time, 'status': grafana_backup.running_status})
+    write_local(backup_folder, "objects/aa/unreferenced.json", {})
+    age_objects(backup_folder)
+    grafana_backup.prune_grafana_backup(["all"])
+    assert "objects/aa/unreferenced.json" not in get_objects(backup_folder)
+
+def test_reused_objects_are_refreshed(tmp_path, grafana_server, backup_config):
+    backup_folder = str(tmp_path/"backup")
+    backup_config(layout=grafana_backup.cas_layout)
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type)
+    age_objects(backup_folder)
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type)
+    oldest_modified = time.time()-3600
+    assert all(os.path.getmtime(os.path.join(backup_folder, key)) > oldest_modified for key in get_objects(backup_folder))
+
+def test_prune_s3_objects(s3_client, bucket_name, grafana_server, backup_config):
+    backup_config(s3=True, layout=grafana_backup.cas_layout, retention={'min_object_age_hours': 0})
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type)
+    def list_objects():
+        return sorted(item['Key'] for item in s3_client.list_objects_v2(Bucket=bucket_name, Prefix="grafana/backup/objects/").get('Contents', []))
+    referenced = list_objects()
+    modified = {item['Key']: item['LastModified'] for item in s3_client.list_objects_v2(Bucket=bucket_name, Prefix="grafana/backup/objects/")['Contents']}
+    s3_client.put_object(Bucket=bucket_name, Key="grafana/backup/objects/aa/unreferenced.json", Body=b"{}")
+    reports = grafana_backup.prune_grafana_backup(["all"])
+    assert reports['s3']['objects'][0] == 1
+    assert list_objects() == referenced
+
+    time.sleep(1)
+    grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type)
+    assert all(item['LastModified'] > modified[item['Key']] for item in s3_client.list_objects_v2(Bucket=bucket_name, Prefix="grafana/backup/objects/")['Contents'])
@@ -0,0 +1,74 @@
+import io
+import threading
+import grafana_s3
+import grafana_backup
+
+def get_keys(client, bucket_name):
+    return sorted(obj['Key'] for obj in client.list_objects_v2(Bucket=bucket_name).get('Contents', []))
+
+def test_shared_client(s3_client):
+    assert grafana_s3.get_s3_client() is s3_client
+    assert grafana_s3.get_s3_client(10) is s3_client
+
+def test_writer_uploads(s3_client, bucket_name):
+    writer = grafana_s3.S3Writer(s3_client, bucket_name, workers=2, queue_size=2)
+    try:
+        for index in range(5):
+            writer.put("backup/{}.json".format(index), io.BytesIO('{{"index": {}}}'.format(index).encode('utf-8')))
+        assert writer.flush() == []
+    finally:
+        writer.close()
+    assert get_keys(s3_client, bucket_name) == ["backup/{}.json".format(index) for index in range(5)]
+    assert s3_client.get_object(Bucket=bucket_name, Key="backup/3.json")["Body"].read() == b'{"index": 3}'
+
+def test_writer_multipart_upload(s3_client, bucket_name):
+    content = b"x"*(6*1024*1024)
+    writer = grafana_s3.S3Writer(s3_client, bucket_name, workers=1, multipart_threshold=5*1024*1024)
+    try:
+        writer.put("backup/large.json", io.BytesIO(content))
+        assert writer.flush() == []
+    finally:
+        writer.close()
+    assert s3_client.get_object(Bucket=bucket_name, Key="backup/large.json")["Body"].read() == content
+
+def test_writer_reports_failed_keys(s3_client, bucket_name):
+    writer = grafana_s3.S3Writer(s3_client, "missing-bucket", workers=2)
+    try:
+        writer.put("backup/a.json", io.BytesIO(b"{}"))
+        writer.put("backup/b.json", io.BytesIO(b"{}"))
+        errors = writer.flush()
+        assert sorted(key for key, error in errors) == ["backup/a.json", "backup/b.json"]
+        assert writer.flush() == []
+    finally:
+        writer.close()
+    assert get_keys(s3_client, bucket_name) == []
+
+def test_writer_reports_failures_per_host(s3_client, bucket_name):
+    writer = grafana_s3.S3Writer(s3_client, bucket_name, workers=2)
+    upload_fileobj = s3_client.upload_fileobj
+    def failing_upload_fileobj(fp, bucket, key, **kwargs):
+        if key.startswith("h2/"):
+            raise Exception("injected failure")
+        return upload_fileobj(fp, bucket, key, **kwargs)
+    s3_client.upload_fileobj = failing_upload_fileobj
+    try:
+        writer.put("h1/a.json", io.BytesIO(b"{}"), "h1")
+        writer.put("h2/a.json", io.BytesIO(b"{}"), "h2")
+        assert writer.flush("h1") == []
+        assert [key for key, error in writer.flush("h2")] == ["h2/a.json"]
+    finally:
+        del s3_client.upload_fileobj
+        writer.close()
+    assert get_keys(s3_client, bucket_name) == ["h1/a.json"]
+
+def test_managers_share_one_writer(s3_client, grafana_server, backup_config):
+    content = backup_config(s3=True)
+    content['grafana_urls'].append(dict(content['grafana_urls'][0], name="h2"))
+    with open(grafana_backup.GrafanaBackupManager.grafana_config, 'w') as fp:
+        grafana_backup.json.dump(content, fp)
+    managers = grafana_backup.get_backup_managers()
+    assert len(managers) == 2 and managers[0].s3_writer is managers[1].s3_writer
+    for operation in range(2):
+        grafana_backup.backup_grafana_dashboard(grafana_backup.hourly_backup_type)
+    writer_threads = [thread for thread in threading.enumerate() if thread.name.startswith("s3-writer-")]
+    assert len(writer_threads) == len(managers[0].s3_writer.workers)
@@ -0,0 +1,67 @@
+import json
+import time
+import asyncio
+import pytest
+import aiohttp
+import grafana_sdk
+import grafana_metrics
+import grafana_async
+import grafana_scheduler
+
+def get_api(grafana_server):
+    return grafana_sdk.GrafanaApi("http://127.0.0.1:{}".format(grafana_server.server_address[1]), "test", max_retries=2, backoff_factor=0)
+
+def test_get_is_retried(grafana_server):
+    grafana_server.failing_paths.add("/api/dashboards/uid/u1")
+    with pytest.raises(Exception):
+        get_api(grafana_server).dashboard_details("u1")
+    assert grafana_server.requests == [("GET", "/api/dashboards/uid/u1")]*3
+
+def test_post_is_not_retried_on_server_error(grafana_server):
+    grafana_server.failing_paths.update(["/api/folders", "/api/dashboards/db/"])
+    api = get_api(grafana_server)
+    api.create_folder("folder")
+    api.restore(json.dumps({"dashboard": {"uid": "u1"}}))
+    assert grafana_server.requests == [("POST", "/api/folders"), ("POST", "/api/dashboards/db/")]
+
+def test_async_post_is_not_retried_on_server_error(grafana_server):
+    grafana_server.failing_paths.add("/api/dashboards/db/")
+    async def restore():
+        async with aiohttp.ClientSession() as session:
+            return await grafana_async.AsyncGrafanaApi(get_api(grafana_server), session).restore(json.dumps({"dashboard": {"uid": "u1"}}))
+    assert asyncio.run(restore()) == {"message": "boom"}
+    assert grafana_server.requests == [("POST", "/api/dashboards/db/")]
+
+def test_post_is_retried_when_not_sent():
+    api = grafana_sdk.GrafanaApi("http://127.0.0.1:1", "test", max_retries=2, backoff_factor=0, name="unsent")
+    with pytest.raises(Exception):
+        api.create_folder("folder")
+    assert grafana_metrics.registry.values[('grafana_backup_retries_total', (('host', "unsent"), ('phase', "folder")))] == 2
+
+def test_retry_after_is_capped(grafana_server):
+    assert grafana_sdk.get_retry_delay(0, 0, "3600", max_backoff=5) == 5
+    assert grafana_sdk.get_retry_delay(0, 0, "Wed, 21 Oct 2099 07:28:00 GMT", max_backoff=5) == 5
+    grafana_server.failing_paths.add("/api/dashboards/uid/u1")
+    grafana_server.retry_after = "3600"
+    api = grafana_sdk.GrafanaApi("http://127.0.0.1:{}".format(grafana_server.server_address[1]), "test", max_retries=2, max_backoff=0.1)
+    start = time.monotonic()
+    with pytest.raises(Exception):
+        api.dashboard_details("u1")
+    assert time.monotonic()-start < 5
+    assert len(grafana_server.requests) == 3
+
+def test_retry_stops_at_deadline(grafana_server):
+    grafana_server.failing_paths.add("/api/dashboards/uid/u1")
+    grafana_server.retry_after = "30"
+    api = get_api(grafana_server)
+    api.deadline = grafana_scheduler.RunDeadline(5)
+    start = time.monotonic()
+    with pytest.raises(Exception):
+        api.dashboard_details("u1")
+    async def dashboard_details():
+        async with aiohttp.ClientSession() as session:
+            return await grafana_async.AsyncGrafanaApi(api, session).dashboard_details("u1")
+    with pytest.raises(Exception):
+        asyncio.run(dashboard_details())
+    assert time.monotonic()-start < 5
+    assert grafana_server.requests == [("GET", "/api/dashboards/uid/u1")]*2